@@ -11,46 +11,55 @@
 """
 
 import os
-from flask import Flask, render_template_string, request
+from flask import Flask, render_template, request
+from jinja2 import DictLoader
 
 PREFIX = os.environ.get("PREFIX", "/")
 
+# The HTML templates used by the app, by name.
+TEMPLATES = {
+    "index.html": """
+<html>
+<head>
+    <title>Example Flask application</title>
+    <style>
+        body { font-family: Arial, sans-serif; margin: 0; padding: 20px; }
+        h1 { color: #333; }
+        table { border-collapse: collapse; width: 100%; }
+        th, td { text-align: left; padding: 8px; border-bottom: 1px solid #ddd; }
+        tr:nth-child(even) { background-color: #f2f2f2; }
+        th { background-color: #4CAF50; color: white; }
+    </style>
+</head>
+<body>
+    <h1>Hello {{ headers.get('X-Forwarded-Display-Name', 'Unknown') }}!</h1>
+    <h2>Request Headers</h2>
+    <table>
+        <tr>
+            <th>Header</th>
+            <th>Value</th>
+        </tr>
+        {% for header, value in headers.items() %}
+        <tr>
+            <td style="white-space: nowrap;">{{ header }}</td>
+            <td style="word-break: break-all; word-wrap: break-word;">{{ value }}</td>
+        </tr>
+        {% endfor %}
+    </table>
+</body>
+</html>
+""",
+}
+
 app = Flask(__name__)
 
+# Compile the templates once, when the app is loaded, instead of on every
+# request as render_template_string() would.
+app.jinja_loader = DictLoader(TEMPLATES)
+for name in TEMPLATES:
+    app.jinja_env.get_template(name)
+
 @app.get(PREFIX)
 def root():
     headers = dict(request.headers)
-    
-    html = """
-    <html>
-    <head>
-        <title>Example Flask application</title>
-        <style>
-            body { font-family: Arial, sans-serif; margin: 0; padding: 20px; }
-            h1 { color: #333; }
-            table { border-collapse: collapse; width: 100%; }
-            th, td { text-align: left; padding: 8px; border-bottom: 1px solid #ddd; }
-            tr:nth-child(even) { background-color: #f2f2f2; }
-            th { background-color: #4CAF50; color: white; }
-        </style>
-    </head>
-    <body>
-        <h1>Hello {{ headers.get('X-Forwarded-Display-Name', 'Unknown') }}!</h1>
-        <h2>Request Headers</h2>
-        <table>
-            <tr>
-                <th>Header</th>
-                <th>Value</th>
-            </tr>
-            {% for header, value in headers.items() %}
-            <tr>
-                <td style="white-space: nowrap;">{{ header }}</td>
-                <td style="word-break: break-all; word-wrap: break-word;">{{ value }}</td>
-            </tr>
-            {% endfor %}
-        </table>
-    </body>
-    </html>
-    """
-    
-    return render_template_string(html, headers=headers)
+    return render_template("index.html", headers=headers)
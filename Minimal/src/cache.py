@@ -0,0 +1,107 @@
+# Enthought product code
+#
+# (C) Copyright 2010-2022 Enthought, Inc., Austin, TX
+# All rights reserved.
+#
+# This file and its contents are confidential information and NOT open source.
+# Distribution is prohibited.
+
+"""
+    A small in-process cache for the results of slow calls, such as calls
+    to the Edge API.
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    """A call to a fetch function, which other threads can wait for."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    """Cache values for ``ttl`` seconds, and refresh them in the background.
+
+    get() returns a cached value while it is fresh.  Once it is older than
+    ``ttl`` seconds, but not older than ``stale_ttl``, the old value is
+    still returned at once, and a background thread fetches a new one
+    ("stale-while-revalidate").  Only when there is no usable value does
+    get() wait for the fetch.
+
+    There is at most one fetch per key in flight: threads that miss the
+    same key at the same time wait for that one fetch, rather than each
+    calling upstream.
+    """
+
+    def __init__(self, ttl=30, stale_ttl=600):
+        self.ttl = ttl
+        self.stale_ttl = max(ttl, stale_ttl)
+        self._lock = threading.Lock()
+        # key -> (value, time fetched)
+        self._values = {}
+        # key -> _Call, for fetches in flight
+        self._calls = {}
+
+    def get(self, key, fetch):
+        """Return the value for ``key``, calling ``fetch()`` if needed.
+
+        If ``fetch`` raises while nobody has a usable value, the error is
+        raised to every caller waiting for it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            cached = self._values.get(key)
+            if cached is not None:
+                value, fetched = cached
+                age = now - fetched
+                if age <= self.ttl:
+                    return value
+                if age <= self.stale_ttl:
+                    if key not in self._calls:
+                        call = self._calls[key] = _Call()
+                        threading.Thread(
+                            target=self._fetch, args=(key, fetch, call), daemon=True
+                        ).start()
+                    return value
+
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if leader:
+            self._fetch(key, fetch, call)
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.value
+
+    def invalidate(self, key=None):
+        """Forget the value for ``key``, or all values."""
+        with self._lock:
+            if key is None:
+                self._values.clear()
+            else:
+                self._values.pop(key, None)
+
+    def _fetch(self, key, fetch, call):
+        try:
+            call.value = fetch()
+        except Exception as e:
+            # Keep serving the stale value, if any, and try again next time.
+            logger.warning("Could not refresh %r: %s", key, e)
+            call.error = e
+        with self._lock:
+            if call.error is None:
+                self._values[key] = (call.value, time.monotonic())
+            del self._calls[key]
+        call.done.set()
@@ -0,0 +1,113 @@
+# Enthought product code
+#
+# (C) Copyright 2010-2022 Enthought, Inc., Austin, TX
+# All rights reserved.
+#
+# This file and its contents are confidential information and NOT open source.
+# Distribution is prohibited.
+
+"""
+    Run independent calls to the Edge API at the same time.
+
+    Each EdgeSession call is a blocking round trip to the Edge server, so a
+    page that needs several of them waits for the sum of their latencies.
+    Running them on a shared thread pool makes it wait only for the slowest.
+
+    This module only uses the standard library, and does not depend on the
+    web framework: it can be copied into Flask, Dash or Panel apps as is.
+    Code running in an asyncio event loop can await the futures returned by
+    submit() with asyncio.wrap_future().
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+# Number of threads making Edge API calls, shared by all requests
+EDGE_CALL_THREADS = int(os.environ.get("EDGE_CALL_THREADS", "8"))
+
+# Default seconds to wait for each call
+EDGE_CALL_TIMEOUT = float(os.environ.get("EDGE_CALL_TIMEOUT", "10"))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _executor():
+    """Return the shared thread pool, creating it on first use.
+
+    The pool is created lazily so that it is created in each worker process,
+    after a pre-forking server such as gunicorn has forked.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=EDGE_CALL_THREADS, thread_name_prefix="edge-call"
+            )
+        return _pool
+
+
+def submit(fn, *args, **kwargs):
+    """Start ``fn(*args, **kwargs)`` on the shared pool; return a Future."""
+    return _executor().submit(fn, *args, **kwargs)
+
+
+def result(future, timeout=None):
+    """Wait for the result of a future returned by submit().
+
+    Raises TimeoutError if it takes longer than ``timeout`` seconds (by
+    default EDGE_CALL_TIMEOUT).  The call itself cannot be interrupted, and
+    goes on in the background.
+    """
+    if timeout is None:
+        timeout = EDGE_CALL_TIMEOUT
+    try:
+        return future.result(timeout)
+    except FutureTimeoutError:
+        raise TimeoutError(f"Edge API call timed out after {timeout} s") from None
+
+
+def gather(*calls, timeout=None, return_exceptions=False):
+    """Run the functions ``calls`` at the same time, and return their results.
+
+    ``calls`` are functions taking no arguments, such as
+    ``edge_session.whoami`` or ``lambda: edge_session.files.list_files()``.
+    ``timeout`` is the seconds to wait for each call, as one number for all
+    of them or a sequence with one per call; it defaults to
+    EDGE_CALL_TIMEOUT.
+
+    The first error raised by a call, or TimeoutError, is raised once all
+    calls finished or timed out.  With ``return_exceptions``, errors are
+    returned in place of the results instead.
+    """
+    if timeout is None or isinstance(timeout, (int, float)):
+        timeouts = [timeout] * len(calls)
+    else:
+        timeouts = list(timeout)
+        if len(timeouts) != len(calls):
+            raise ValueError("timeout must have one value per call")
+
+    start = time.monotonic()
+    futures = [submit(call) for call in calls]
+    results = []
+    for future, call_timeout in zip(futures, timeouts):
+        if call_timeout is None:
+            call_timeout = EDGE_CALL_TIMEOUT
+        # All calls started together, so each timeout counts from the start.
+        remaining = max(0.0, start + call_timeout - time.monotonic())
+        try:
+            results.append(future.result(remaining))
+        except FutureTimeoutError:
+            results.append(
+                TimeoutError(f"Edge API call timed out after {call_timeout} s")
+            )
+        except Exception as e:
+            results.append(e)
+    if not return_exceptions:
+        for value in results:
+            if isinstance(value, Exception):
+                raise value
+    return results
@@ -0,0 +1,206 @@
+# Enthought product code
+#
+# (C) Copyright 2010-2022 Enthought, Inc., Austin, TX
+# All rights reserved.
+#
+# This file and its contents are confidential information and NOT open source.
+# Distribution is prohibited.
+
+"""
+    An in-memory index of a tree of folders, listed over the Edge API.
+
+    Listing a deep tree one folder at a time takes one round trip per
+    folder.  FileTree.walk() lists many folders at the same time instead,
+    on a pool of its own with a bound on the number of requests in flight,
+    and keeps what it found so that later walks only list the folders that
+    are out of date.
+"""
+
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import edge_calls
+
+#: The contents of one folder: the names of its subfolders (ending with
+#: "/"), the names of its files, and the time it was listed.
+Folder = namedtuple("Folder", ["folders", "files", "listed"])
+
+
+class FileTree:
+    """Index of the folders below the root of a file store.
+
+    ``list_folder(path)`` lists one folder, given its path ("" for the
+    root, otherwise ending with "/"), and returns the names of its
+    subfolders and of its files.  Listings older than ``max_age`` seconds
+    are listed again when they are next needed.
+    """
+
+    def __init__(self, list_folder, max_age=30, max_in_flight=8):
+        self.list_folder = list_folder
+        self.max_age = max_age
+        self.max_in_flight = max_in_flight
+        self._lock = threading.Lock()
+        # path -> Folder
+        self._folders = {}
+        # Progress of the current or last walk; see status()
+        self._walk = {"running": False, "listed": 0, "failed": {}}
+        self._pool = None
+
+    def folder(self, path=""):
+        """Return the Folder at ``path``, listing it if it is not up to date."""
+        with self._lock:
+            folder = self._folders.get(path)
+        if folder is None or self._stale(folder):
+            folder = self._list(path)
+        return folder
+
+    def walk(self, path=""):
+        """List the whole tree below ``path``, many folders at a time.
+
+        Folders listed less than ``max_age`` seconds ago are not listed
+        again, but their subfolders are still visited, so calling walk()
+        again only refreshes what is out of date.  A folder that cannot be
+        listed, or takes more than EDGE_CALL_TIMEOUT seconds, is recorded
+        in the "failed" entry of status() and skipped, with its subtree.
+        Returns the number of folders listed.
+        """
+        with self._lock:
+            self._walk = {"running": True, "listed": 0, "failed": {}}
+        try:
+            self._walk_tree(path)
+        finally:
+            with self._lock:
+                self._walk["running"] = False
+        return self._walk["listed"]
+
+    def start_walk(self, path=""):
+        """Run walk() in a background thread.
+
+        Returns False if a walk is already running.  Its progress is
+        reported by status().
+        """
+        with self._lock:
+            if self._walk["running"]:
+                return False
+            self._walk = {"running": True, "listed": 0, "failed": {}}
+        threading.Thread(target=self.walk, args=(path,), daemon=True).start()
+        return True
+
+    def status(self):
+        """Return the progress of the current or last walk.
+
+        This is a dict with whether a walk is "running", the number of
+        folders "listed" so far, and the path and error of the folders that
+        "failed".
+        """
+        with self._lock:
+            return {**self._walk, "failed": dict(self._walk["failed"])}
+
+    def _executor(self):
+        # Walks have a pool of their own, so that calls that hang cannot hold
+        # up the Edge API calls of the pages, which use edge_calls.  It is
+        # created on first use, after a pre-forking server has forked.
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.max_in_flight, thread_name_prefix="file-tree"
+                )
+            return self._pool
+
+    def _walk_tree(self, path):
+        timeout = edge_calls.EDGE_CALL_TIMEOUT
+        # future -> path of the folder it lists
+        pending = {}
+        # path -> time its call started, set by the pool thread
+        started = {}
+        # Calls that timed out, but still hold a thread of the pool
+        abandoned = set()
+        queue = [path]
+        while queue or pending:
+            abandoned = {future for future in abandoned if not future.done()}
+            while queue and len(pending) + len(abandoned) < self.max_in_flight:
+                folder_path = queue.pop()
+                with self._lock:
+                    folder = self._folders.get(folder_path)
+                if folder is not None and not self._stale(folder):
+                    queue.extend(folder_path + name for name in folder.folders)
+                    continue
+                future = self._executor().submit(self._timed_list, folder_path, started)
+                pending[future] = folder_path
+
+            if not pending:
+                # Every thread is held by a call that timed out.
+                if not wait(abandoned, timeout, FIRST_COMPLETED).done:
+                    error = TimeoutError(f"No Edge API call returned in {timeout} s")
+                    for folder_path in queue:
+                        self._failed(folder_path, error)
+                    return
+                continue
+
+            # Wait until a call finishes, or the first one running times out.
+            deadlines = [
+                started[folder_path] + timeout
+                for folder_path in pending.values()
+                if folder_path in started
+            ]
+            first = min(deadlines) - time.monotonic() if deadlines else timeout
+            done, _ = wait(pending, max(0.0, first), FIRST_COMPLETED)
+            for future in done:
+                folder_path = pending.pop(future)
+                started.pop(folder_path, None)
+                try:
+                    folder = future.result()
+                except Exception as e:
+                    self._failed(folder_path, e)
+                    continue
+                with self._lock:
+                    self._walk["listed"] += 1
+                queue.extend(folder_path + name for name in folder.folders)
+
+            now = time.monotonic()
+            for future, folder_path in list(pending.items()):
+                if folder_path in started and started[folder_path] + timeout <= now:
+                    # Give up on it; the call goes on in the background.
+                    del pending[future]
+                    del started[folder_path]
+                    abandoned.add(future)
+                    self._failed(
+                        folder_path, TimeoutError(f"Timed out after {timeout} s")
+                    )
+
+    def _timed_list(self, path, started):
+        started[path] = time.monotonic()
+        return self._list(path)
+
+    def _failed(self, path, error):
+        with self._lock:
+            self._walk["failed"][path] = str(error) or type(error).__name__
+
+    def size(self):
+        """Return the number of folders and files in the index."""
+        with self._lock:
+            folders = list(self._folders.values())
+        return len(folders), sum(len(folder.files) for folder in folders)
+
+    def _stale(self, folder):
+        return time.monotonic() - folder.listed > self.max_age
+
+    def _list(self, path):
+        """List the folder at ``path`` and update the index."""
+        folders, files = self.list_folder(path)
+        folder = Folder(sorted(folders), sorted(files), time.monotonic())
+        with self._lock:
+            old = self._folders.get(path)
+            self._folders[path] = folder
+            if old is not None:
+                # Forget the subtrees of the folders that were removed
+                removed = tuple(
+                    path + name for name in set(old.folders) - set(folder.folders)
+                )
+                if removed:
+                    for other in list(self._folders):
+                        if other.startswith(removed):
+                            del self._folders[other]
+        return folder
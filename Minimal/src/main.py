@@ -11,14 +11,39 @@
 """
 
 import os
-from flask import Flask, render_template_string
+from flask import Flask, Response, abort, render_template, request, stream_with_context
+from jinja2 import DictLoader
 
 from edge.api import EdgeSession
 
+import edge_calls
+from cache import TTLCache
+from file_tree import FileTree
+
 # Your app will be served by Edge under this URL prefix.
 # Please note the value will contain a trailing "/" character.
 PREFIX = os.environ.get("JUPYTERHUB_SERVICE_PREFIX", "/")
 
+# Seconds for which answers from the Edge API are served without asking again.
+# Older answers, up to EDGE_CACHE_STALE_TTL seconds old, are still served at
+# once while a fresh copy is fetched in the background.
+EDGE_CACHE_TTL = float(os.environ.get("EDGE_CACHE_TTL", "30"))
+EDGE_CACHE_STALE_TTL = float(os.environ.get("EDGE_CACHE_STALE_TTL", "600"))
+
+# Number of files listed per page, by default and at most.
+FILES_PAGE_SIZE = int(os.environ.get("FILES_PAGE_SIZE", "1000"))
+FILES_MAX_PAGE_SIZE = int(os.environ.get("FILES_MAX_PAGE_SIZE", "10000"))
+
+# Seconds to wait for the file listing of the home page.  It is waited for
+# while the page is being sent, after the other Edge API calls, and a large
+# listing can take much longer than EDGE_CALL_TIMEOUT when it is not cached.
+# Keep it below the gunicorn worker timeout, GUNICORN_TIMEOUT in
+# "startup-script.sh".
+FILES_LIST_TIMEOUT = float(os.environ.get("FILES_LIST_TIMEOUT", "120"))
+
+# Most folders listed at the same time when walking the whole file tree.
+TREE_MAX_IN_FLIGHT = int(os.environ.get("TREE_MAX_IN_FLIGHT", "8"))
+
 
 def get_edge_session():
     """Helper function to get an EdgeSession object.
@@ -47,42 +72,226 @@ def get_edge_session():
 
 
 edge_session = get_edge_session()
+edge_cache = TTLCache(EDGE_CACHE_TTL, EDGE_CACHE_STALE_TTL)
+# The HTML templates used by the app, by name.
+TEMPLATES = {
+    "hello.html": """\
+<html><body>
+<h1>Hello World!</h1>
+<p>To see more information, run this app in Edge or set up
+the "dev_settings.json" file locally.</p>
+</body></html>""",
+    "index.html": """\
+<html><body>
+<h1>Hello {{ user_name }}!</h1>
+<p>
+Welcome!  You are in the "{{ edge_session.organization }}" organization.
+</p>
+<p>
+Here is a list of the files in your organization (top folder only):
+<ul>
+{% for fname in page %}
+<li>{{ fname }}</li>
+{% endfor %}
+</ul>
+{% if page.error %}
+Could not list the files: {{ page.error }}
+{% elif page.start < page.total %}
+Files {{ page.start + 1 }} to {{ page.end }} of {{ page.total }}.
+{% endif %}
+{% if page.start > 0 and not page.error %}
+<a href="?start={{ [page.start - page.limit, 0] | max }}&limit={{ page.limit }}">Previous</a>
+{% endif %}
+{% if not page.error and page.end < page.total %}
+<a href="?start={{ page.end }}&limit={{ page.limit }}">Next</a>
+{% endif %}
+</p>
+<p><a href="tree">Browse all folders</a></p>
+<p>This example is served from: "{{ example_served_from }}".</p>
+</body></html>
+""",
+    "tree.html": """\
+<html><body>
+<h1>Files in the "{{ edge_session.organization }}" organization</h1>
+<p>
+{% if walk.running %}
+Listing all folders in the background: {{ walk.listed }} folder(s) so far.
+<a href="tree">Reload</a> to see the progress.
+{% elif walk.listed or walk.failed %}
+Listed {{ walk.listed }} folder(s); the index holds {{ folders }} folder(s)
+and {{ files }} file(s).  <a href="?recursive=1">Refresh</a>
+{% else %}
+Folders are listed when you open them.
+<a href="?recursive=1">List all folders now</a>.
+{% endif %}
+</p>
+{% if walk.failed %}
+<p>These folders could not be listed:</p>
+<ul>
+{% for path, error in walk.failed | dictsort %}
+<li>{{ path or "/" }}: {{ error }}</li>
+{% endfor %}
+</ul>
+{% endif %}
+<ul>
+{% include "folder.html" %}
+</ul>
+<script>
+// Load the contents of a folder the first time it is opened.
+document.addEventListener("toggle", async (event) => {
+  const details = event.target;
+  if (!details.open || details.dataset.loaded) {
+    return;
+  }
+  details.dataset.loaded = "true";
+  const response = await fetch(
+    "tree/folder?path=" + encodeURIComponent(details.dataset.path)
+  );
+  details.querySelector("ul").innerHTML = await response.text();
+}, true);
+</script>
+</body></html>
+""",
+    "folder.html": """\
+{% for name in folder.folders %}
+<li><details data-path="{{ path }}{{ name }}">
+<summary>{{ name }}</summary>
+<ul><li>Loading...</li></ul>
+</details></li>
+{% endfor %}
+{% for name in folder.files %}
+<li>{{ name }}</li>
+{% endfor %}
+""",
+}
+
 app = Flask(__name__)
 
+# Compile the templates once, when the app is loaded, instead of on every
+# request as render_template_string() would.
+app.jinja_loader = DictLoader(TEMPLATES)
+for name in TEMPLATES:
+    app.jinja_env.get_template(name)
+
+
+def list_folder(path):
+    """List one folder of the organization's files.
+
+    Returns the names of the subfolders, which end with "/", and of the
+    files in the folder at ``path`` ("" for the top folder).
+    """
+    if path:
+        names = edge_session.files.list_files(path)
+    else:
+        names = edge_session.files.list_files()
+    folders, files = [], []
+    for name in names:
+        # Keep the names relative to the folder
+        if name.startswith(path):
+            name = name[len(path):]
+        if name:
+            (folders if name.endswith("/") else files).append(name)
+    return folders, files
+
+
+file_tree = FileTree(list_folder, EDGE_CACHE_TTL, TREE_MAX_IN_FLIGHT)
+
+
+class FilePage:
+    """One page of the file listing.
+
+    ``files`` is a future for the listing, from edge_calls.submit().  It is
+    only waited for when the page is first iterated, so the start of the
+    HTML can be sent before the listing arrives.  By then the response has
+    started and can no longer become an error page, so if the listing fails
+    or takes more than FILES_LIST_TIMEOUT seconds, the page is empty and
+    ``error`` holds the message to show instead.
+    """
+
+    def __init__(self, files, start, limit):
+        self.files = files
+        self.start = start
+        self.limit = limit
+        self.total = None
+        self.error = None
+
+    def __iter__(self):
+        try:
+            files = edge_calls.result(self.files, FILES_LIST_TIMEOUT)
+        except Exception as e:
+            app.logger.exception("Could not list the files")
+            self.error = str(e) or type(e).__name__
+            self.total = 0
+            return iter(())
+        self.total = len(files)
+        return iter(files[self.start:self.start + self.limit])
+
+    @property
+    def end(self):
+        return min(self.start + self.limit, self.total)
+
 
 @app.get(PREFIX)
 def root():
     """Example Flask route"""
 
     if edge_session is None:
-        html = """\
-        <html><body>
-        <h1>Hello World!</h1>
-        <p>To see more information, run this app in Edge or set up
-        the "dev_settings.json" file locally.</p>
-        </body></html>"""
-        return render_template_string(html)
-
-    html = """\
-    <html><body>
-    <h1>Hello {{ edge_session.whoami().user_name }}!</h1>
-    <p>
-    Welcome!  You are in the "{{ edge_session.organization }}" organization.
-    </p>
-    <p>
-    Here is a list of the files in your organization (top folder only):
-    <ul>
-    {% for fname in edge_session.files.list_files() %}
-    <li>{{ fname }}</li>
-    {% endfor %}
-    </ul>
-    </p>
-    <p>This example is served from: "{{ example_served_from }}".</p>
-    </body></html>
-    """
+        return render_template("hello.html")
 
-    return render_template_string(
-        html,
+    # Ask for the user name and the listing at the same time.
+    files = edge_calls.submit(
+        edge_cache.get, "files", lambda: list(edge_session.files.list_files())
+    )
+    user_name = edge_calls.result(edge_calls.submit(
+        edge_cache.get, "user_name", lambda: edge_session.whoami().user_name
+    ))
+    limit = request.args.get("limit", FILES_PAGE_SIZE, type=int)
+    limit = min(max(1, limit), FILES_MAX_PAGE_SIZE)
+    start = max(0, request.args.get("start", 0, type=int))
+    page = FilePage(files, start, limit)
+
+    # Send the page as it is rendered, rather than building it in memory first.
+    template = app.jinja_env.get_template("index.html")
+    stream = template.generate(
         edge_session=edge_session,
+        user_name=user_name,
+        page=page,
         example_served_from=PREFIX,
     )
+    return Response(stream_with_context(stream), mimetype="text/html")
+
+
+@app.get(PREFIX + "tree")
+def tree():
+    """Collapsible tree of all the files, loaded folder by folder.
+
+    With "?recursive=1", the whole tree is listed in the background, so
+    that opening folders later does not need to wait for the Edge API.  The
+    page is returned at once, with the progress of the listing.
+    """
+    if edge_session is None:
+        return render_template("hello.html")
+
+    if request.args.get("recursive"):
+        file_tree.start_walk()
+    folders, files = file_tree.size()
+    return render_template(
+        "tree.html",
+        edge_session=edge_session,
+        folder=file_tree.folder(),
+        path="",
+        walk=file_tree.status(),
+        folders=folders,
+        files=files,
+    )
+
+
+@app.get(PREFIX + "tree/folder")
+def tree_folder():
+    """The contents of one folder, as HTML list items."""
+    if edge_session is None:
+        abort(404)
+    path = request.args.get("path", "")
+    if path and not path.endswith("/"):
+        abort(400)
+    return render_template("folder.html", folder=file_tree.folder(path), path=path)
@@ -10,4 +10,8 @@ if [ -z $HOST_ADDRESS ]; then
   export HOST_ADDRESS='127.0.0.1';
 fi
 
-exec edm run -- gunicorn main:app -b ${HOST_ADDRESS}:9000
+# Threaded workers, so that a page waiting on a slow Edge API call does not
+# hold up the other requests.  The worker timeout must stay above
+# FILES_LIST_TIMEOUT (see main.py), or a slow listing gets the worker killed
+# in the middle of the page.
+exec edm run -- gunicorn main:app -b ${HOST_ADDRESS}:9000 --threads ${GUNICORN_THREADS:-8} --timeout ${GUNICORN_TIMEOUT:-150}
@@ -0,0 +1,119 @@
+# Enthought product code
+#
+# (C) Copyright 2010-2022 Enthought, Inc., Austin, TX
+# All rights reserved.
+#
+# This file and its contents are confidential information and NOT open source.
+# Distribution is prohibited.
+
+"""
+    Benchmark for the "max_detect_dimension" option of the face detector.
+
+    Each image given on the command line is resized to 4K (3840 pixels on its
+    longest side).  Faces are detected at full resolution, which is used as
+    the reference, and then with each of the requested maximum dimensions.
+    For each setting, the mean detection time, the speedup, and the recall
+    and precision against the reference are reported.
+
+    Usage:  python benchmarks/downscale.py photo1.jpg photo2.jpg ...
+"""
+
+import argparse
+import os.path as op
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), "..", "src"))
+
+from application.opencv_model.model import find_faces  # noqa: E402
+
+SIZE_4K = 3840
+
+
+def load_4k_gray(path):
+    """Load an image as grayscale, resized to 4K on its longest side."""
+    img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise ValueError(f"Could not read image {path!r}")
+    scale = SIZE_4K / max(img.shape)
+    return cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
+
+
+def iou(a, b):
+    """Intersection over union of two (x, y, w, h) rectangles."""
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    w = min(ax + aw, bx + bw) - max(ax, bx)
+    h = min(ay + ah, by + bh) - max(ay, by)
+    if w <= 0 or h <= 0:
+        return 0.0
+    inter = w * h
+    return inter / (aw * ah + bw * bh - inter)
+
+
+def matches(found, reference, threshold=0.5):
+    """Count the rectangles of ``found`` matching one of ``reference``."""
+    unmatched = list(reference)
+    count = 0
+    for rect in found:
+        best = max(unmatched, key=lambda ref: iou(rect, ref), default=None)
+        if best is not None and iou(rect, best) >= threshold:
+            unmatched.remove(best)
+            count += 1
+    return count
+
+
+def timed(gray, params, repeat):
+    """Return the faces found and the best time of ``repeat`` runs."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        faces = find_faces(gray, params)
+        best = min(best, time.perf_counter() - start)
+    return faces, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("images", nargs="+", help="Photos to use")
+    parser.add_argument(
+        "--dimensions", nargs="+", type=int, default=[640, 960, 1280, 1920],
+        help="Values of max_detect_dimension to compare",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    images = [load_4k_gray(path) for path in args.images]
+    settings = [None] + sorted(args.dimensions, reverse=True)
+    times = {dim: [] for dim in settings}
+    found = {dim: 0 for dim in settings}
+    matched = {dim: 0 for dim in settings}
+
+    for gray in images:
+        reference, _ = timed(gray, {}, args.repeat)
+        for dim in settings:
+            params = {} if dim is None else {"max_detect_dimension": dim}
+            faces, elapsed = timed(gray, params, args.repeat)
+            times[dim].append(elapsed)
+            found[dim] += len(faces)
+            matched[dim] += matches(faces, reference)
+
+    n_reference = found[None]
+    full_time = np.mean(times[None])
+    print(f"{len(images)} image(s), {n_reference} reference face(s)")
+    print(f"{'max dim':>8} {'time (s)':>9} {'speedup':>8} {'recall':>7} {'precision':>9}")
+    for dim in settings:
+        mean_time = np.mean(times[dim])
+        recall = matched[dim] / n_reference if n_reference else float("nan")
+        precision = matched[dim] / found[dim] if found[dim] else float("nan")
+        print(
+            f"{dim or 'full':>8} {mean_time:9.3f} {full_time / mean_time:8.2f}"
+            f" {recall:7.2f} {precision:9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
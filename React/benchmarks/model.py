@@ -0,0 +1,196 @@
+# Enthought product code
+#
+# (C) Copyright 2010-2022 Enthought, Inc., Austin, TX
+# All rights reserved.
+#
+# This file and its contents are confidential information and NOT open source.
+# Distribution is prohibited.
+
+"""
+    Benchmark suite for the OpenCV face detection model.
+
+    Synthetic images are built in code, at resolutions from VGA to 24 MP and
+    encoded as JPEG and PNG.  Each image is run through detect_face for a
+    grid of scaleFactor/minNeighbors values, and the throughput, latency
+    percentiles, mean stage timings and peak RSS are reported.  Each image
+    is benchmarked in its own process, so the peak RSS is per image, and
+    does not include building the image.
+
+    Results are written as JSON, and a previous results file can be given
+    with --compare to print the change in median latency.
+
+    Usage:  python benchmarks/model.py -o results.json [--compare old.json]
+"""
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os.path as op
+import platform
+import resource
+import sys
+import time
+
+import cv2
+import numpy as np
+
+SRC_DIR = op.join(op.dirname(op.abspath(__file__)), "..", "src")
+
+RESOLUTIONS = {
+    "VGA": (640, 480),
+    "HD": (1280, 720),
+    "FHD": (1920, 1080),
+    "4K": (3840, 2160),
+    "12MP": (4000, 3000),
+    "24MP": (6000, 4000),
+}
+FORMATS = ("jpeg", "png")
+SCALE_FACTORS = (1.1, 1.2, 1.4)
+MIN_NEIGHBORS = (3, 4, 6)
+
+
+def synthetic_image(width, height, seed=0):
+    """Build a deterministic color test image, with some structure in it."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    img = np.empty((height, width, 3), np.uint8)
+    img[..., 0] = 127 + 100 * np.sin(x / 37.0)
+    img[..., 1] = 127 + 100 * np.cos(y / 53.0)
+    img[..., 2] = 255 * (x + y) / (width + height)
+    for _ in range(40):
+        center = (int(rng.integers(width)), int(rng.integers(height)))
+        axes = (int(rng.integers(10, width // 8)), int(rng.integers(10, height // 6)))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv2.ellipse(img, center, axes, 0, 0, 360, color, -1)
+    noise = rng.integers(-20, 21, img.shape, dtype=np.int16)
+    return np.clip(img + noise, 0, 255).astype(np.uint8)
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else float("nan")
+
+
+def encoded_image(name, fmt):
+    """Return the synthetic image for a resolution, encoded as ``fmt``."""
+    width, height = RESOLUTIONS[name]
+    _, encoded = cv2.imencode("." + fmt, synthetic_image(width, height))
+    return encoded.tobytes()
+
+
+def run_case(name, fmt, data, repeat):
+    """Benchmark one encoded image; runs in a child process."""
+    sys.path.insert(0, SRC_DIR)
+    from application.opencv_model.model import detect_face
+
+    width, height = RESOLUTIONS[name]
+
+    # Warm up, so the first run does not pay for lazy initialization.
+    detect_face(data, {"output": "boxes"})
+
+    runs = []
+    for scale_factor in SCALE_FACTORS:
+        for min_neighbors in MIN_NEIGHBORS:
+            params = {"scaleFactor": scale_factor, "minNeighbors": min_neighbors}
+            latencies = []
+            stages = {}
+            for _ in range(repeat):
+                timings = {}
+                start = time.perf_counter()
+                detect_face(data, params, timings)
+                latencies.append(time.perf_counter() - start)
+                for stage, seconds in timings.items():
+                    stages[stage] = stages.get(stage, 0.0) + seconds
+            runs.append({
+                "scaleFactor": scale_factor,
+                "minNeighbors": min_neighbors,
+                "throughput": len(latencies) / sum(latencies),
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "stages": {k: v / repeat for k, v in stages.items()},
+            })
+
+    # ru_maxrss is in kilobytes on Linux.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {
+        "resolution": name,
+        "width": width,
+        "height": height,
+        "format": fmt,
+        "encoded_bytes": len(data),
+        "peak_rss_bytes": peak_rss,
+        "runs": runs,
+    }
+
+
+def compare(results, previous):
+    """Print the change in median latency against a previous results file."""
+    def key(case, run):
+        return (case["resolution"], case["format"], run["scaleFactor"],
+                run["minNeighbors"])
+
+    before = {
+        key(case, run): run["p50"]
+        for case in previous["cases"] for run in case["runs"]
+    }
+    print(f"\n{'case':<32} {'p50 before':>10} {'p50 now':>10} {'change':>8}")
+    for case in results["cases"]:
+        for run in case["runs"]:
+            k = key(case, run)
+            if k not in before:
+                continue
+            change = run["p50"] / before[k] - 1
+            label = "{} {} sf={} mn={}".format(*k)
+            print(f"{label:<32} {before[k]:10.4f} {run['p50']:10.4f} {change:+8.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-o", "--output", default="benchmark-results.json")
+    parser.add_argument(
+        "--resolutions", nargs="+", choices=list(RESOLUTIONS),
+        default=list(RESOLUTIONS),
+    )
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=FORMATS)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--compare", help="Previous results file to compare with")
+    args = parser.parse_args()
+
+    results = {
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "machine": platform.machine(),
+        "cpu_count": multiprocessing.cpu_count(),
+        "repeat": args.repeat,
+        "cases": [],
+    }
+
+    ctx = multiprocessing.get_context("spawn")
+    print(f"{'case':<32} {'jobs/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'RSS MB':>8}")
+    for name in args.resolutions:
+        for fmt in args.formats:
+            data = encoded_image(name, fmt)
+            with ctx.Pool(1) as pool:
+                case = pool.apply(run_case, (name, fmt, data, args.repeat))
+            results["cases"].append(case)
+            rss = case["peak_rss_bytes"] / 1024 ** 2
+            for run in case["runs"]:
+                label = f"{name} {fmt} sf={run['scaleFactor']} mn={run['minNeighbors']}"
+                print(
+                    f"{label:<32} {run['throughput']:8.2f} {run['p50']:8.4f}"
+                    f" {run['p95']:8.4f} {run['p99']:8.4f} {rss:8.1f}"
+                )
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
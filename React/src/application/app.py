@@ -10,19 +10,28 @@
     Example for using Edge with Flask/React.
 """
 
+import json
 import os
 import secrets
 import sys
 import threading
-from queue import Empty, Queue
+import time
 from urllib.parse import unquote
 from uuid import uuid4
 
 from edge.api import EdgeSession
-from flask import Flask, render_template, request
+from flask import Flask, Response, render_template, request, session
 from flask_session import Session
-
-from .opencv_model.model import detect_face
+from flask_sock import ConnectionClosed, Sock
+
+from . import metrics
+from .brokers import BrokerWorkers, RedisBroker, make_broker
+from .cache import ResultCache, cache_key, image_digest
+from .jobs import JobExecutor, QueueFull, ResultStore, cpu_quota
+from .opencv_model.model import (
+    CLASSIFIERS, ProcessDetector, detect_face, share_detect_slots,
+)
+from .stream import FaceTracker
 
 
 # The Flask app will be served under this route.  It should appear in e.g.
@@ -58,13 +67,159 @@ def get_edge_session():
 
 EDGE_SESSION = get_edge_session()
 
-# This will be used to hold the compute jobs.
-RESULTS = Queue()
+# This will be used to hold the state and results of the compute jobs.  Each
+# client only sees the jobs it submitted; finished results expire after
+# RESULT_TTL seconds, and the oldest are evicted beyond RESULT_MAX_BYTES.
+#
+# By default they are kept in this process.  JOB_BROKER moves them, and the
+# job queue, to a shared broker ("sqlite:///path/to/jobs.sqlite" or
+# "redis://host:port/db"), so the app can run as several gunicorn workers
+# or pods.
+JOB_BROKER = os.environ.get("JOB_BROKER")
+RESULT_TTL = float(os.environ.get("RESULT_TTL", 600))
+RESULT_MAX_BYTES = int(os.environ.get("RESULT_MAX_BYTES", 256 * 1024 * 1024))
+if JOB_BROKER:
+    RESULTS = make_broker(JOB_BROKER, ttl=RESULT_TTL, max_bytes=RESULT_MAX_BYTES)
+else:
+    RESULTS = ResultStore(ttl=RESULT_TTL, max_bytes=RESULT_MAX_BYTES)
+
+# Compute jobs run on a fixed pool of worker threads, sized to the container's
+# CPU quota unless overridden.  Jobs beyond the queue capacity are rejected
+# with a 429 response, rather than competing with each other for the CPU.
+# DETECT_WORKERS is per process: with several gunicorn workers, they share
+# the quota between them by default.
+GUNICORN_WORKERS = int(os.environ.get("GUNICORN_WORKERS", 1))
+DETECT_WORKERS = int(os.environ.get("DETECT_WORKERS", 0)) or max(
+    1, cpu_quota() // GUNICORN_WORKERS
+)
+DETECT_QUEUE_SIZE = int(os.environ.get("DETECT_QUEUE_SIZE", 4 * DETECT_WORKERS))
+
+# Jobs and video streams (see stream() below) take turns for these slots, so
+# that together they run at most DETECT_WORKERS detections at once.  Tiled
+# jobs search extra tiles in parallel only while slots are free; in the
+# worker processes of DETECT_BACKEND=process, they search one tile at a time.
+DETECT_SLOTS = threading.BoundedSemaphore(DETECT_WORKERS)
+share_detect_slots(DETECT_SLOTS, DETECT_WORKERS)
+
+# The workers take jobs from each client session in turn, so a newcomer's
+# job runs as soon as a worker frees up.  By default, a session alone may
+# use every worker, but only half the queue, so a client submitting a batch
+# of images leaves room for the others.  Lower DETECT_SESSION_WORKERS to
+# keep workers free for other sessions even while one is busy.
+DETECT_SESSION_WORKERS = int(os.environ.get("DETECT_SESSION_WORKERS", DETECT_WORKERS))
+DETECT_SESSION_QUEUE_SIZE = int(
+    os.environ.get("DETECT_SESSION_QUEUE_SIZE", max(1, DETECT_QUEUE_SIZE // 2))
+)
 
+# With DETECT_BACKEND=process, detection runs in a pool of spawned worker
+# processes (one per worker thread), so it can use every core rather than
+# sharing this process's interpreter.
+#
+# Either way, the classifiers are loaded and warmed up here, before gunicorn
+# starts accepting requests, so the first job runs as fast as later ones.
+# If the cascade file can't be loaded, the app fails to start.
+if os.environ.get("DETECT_BACKEND", "thread") == "process":
+    DETECTOR = ProcessDetector(DETECT_WORKERS)
+    detect = DETECTOR.detect_face
+else:
+    CLASSIFIERS.warm_up(DETECT_WORKERS)
+    detect = detect_face
+
+
+# Results are cached by image content and parameters, so repeating a job
+# does not run the detector again.  RESULT_CACHE_BYTES=0 disables the cache;
+# RESULT_CACHE_DIR lets entries evicted from memory spill to disk.
+CACHE_BYTES = int(os.environ.get("RESULT_CACHE_BYTES", 64 * 1024 * 1024))
+if CACHE_BYTES > 0:
+    CACHE = ResultCache(
+        max_bytes=CACHE_BYTES,
+        spill_dir=os.environ.get("RESULT_CACHE_DIR") or None,
+        max_disk_bytes=int(
+            os.environ.get("RESULT_CACHE_DISK_BYTES", 1024 * 1024 * 1024)
+        ),
+    )
+else:
+    CACHE = None
+
+
+# Time spent in each stage of the face detection, and in whole jobs.
+STAGE_SECONDS = metrics.Histogram(
+    "detect_stage_seconds", "Time spent in each stage of face detection.",
+    label="stage",
+)
+JOB_SECONDS = metrics.Histogram(
+    "detect_job_seconds", "Time spent running face detection jobs."
+)
+PREVIEW_SECONDS = metrics.Histogram(
+    "detect_preview_seconds",
+    "Time spent on the preview pass of progressive face detection jobs.",
+)
+FRAME_SECONDS = metrics.Histogram(
+    "detect_stream_frame_seconds", "Time spent on each frame of video streams."
+)
 
-def task(task_id, encoded_string, params):
-    """Compute task result and store it in a global when done."""
-    RESULTS.put((task_id, detect_face(encoded_string, params)))
+
+def task(task_id, encoded_string, params, key=None):
+    """Compute task result and store it in a global when done.
+
+    With ``params["progressive"]``, a coarse preview of the face boxes is
+    published first, as version 1 of the result, and the full-quality
+    result follows.  Both passes share one decoding of the image.
+    """
+    if not RESULTS.start(task_id):
+        # Cancelled or superseded while it was queued
+        return
+    timings = {}
+    start = time.perf_counter()
+
+    on_preview = None
+    if params.get("progressive"):
+        def on_preview(preview, preview_timings):
+            PREVIEW_SECONDS.observe(time.perf_counter() - start)
+            # False if cancelled while the preview was computed
+            return RESULTS.update(task_id, preview, preview_timings)
+
+    try:
+        with DETECT_SLOTS:
+            result = detect(encoded_string, params, timings, on_preview)
+        if result is None:
+            # Cancelled after the preview
+            return
+    except Exception as e:
+        RESULTS.fail(task_id, str(e))
+        return
+    JOB_SECONDS.observe(time.perf_counter() - start)
+    for name, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, name)
+
+    if key is not None:
+        CACHE.put(key, result)
+    RESULTS.finish(task_id, result, timings)
+
+
+# With a broker, every process's workers take jobs from the shared queue, so
+# a job may run in a different process from the one it was submitted to.
+if JOB_BROKER:
+    EXECUTOR = BrokerWorkers(
+        RESULTS, task, DETECT_WORKERS, DETECT_QUEUE_SIZE,
+        max_per_owner=DETECT_SESSION_WORKERS,
+        max_queued_per_owner=DETECT_SESSION_QUEUE_SIZE,
+    )
+
+    def submit_job(task_id, owner, image, params, key=None, group=None):
+        # The broker takes superseded jobs out of its queue itself.
+        EXECUTOR.submit(task_id, owner, image, params, key)
+else:
+    EXECUTOR = JobExecutor(
+        DETECT_WORKERS, DETECT_QUEUE_SIZE,
+        max_per_owner=DETECT_SESSION_WORKERS,
+        max_queued_per_owner=DETECT_SESSION_QUEUE_SIZE,
+    )
+
+    def submit_job(task_id, owner, image, params, key=None, group=None):
+        EXECUTOR.submit(
+            task, task_id, image, params, key, owner=owner, group=group
+        )
 
 
 app = Flask(
@@ -73,10 +228,17 @@ app = Flask(
     static_folder="frontend/dist",
     static_url_path=PREFIX + "static",
 )
-app.config["SESSION_TYPE"] = "filesystem"
-app.config["SECRET_KEY"] = secrets.token_hex()
+if isinstance(RESULTS, RedisBroker):
+    # Share sessions between pods, so a client keeps its id on every pod.
+    app.config["SESSION_TYPE"] = "redis"
+    app.config["SESSION_REDIS"] = RESULTS.client
+else:
+    app.config["SESSION_TYPE"] = "filesystem"
+# Set SECRET_KEY to the same value in every process serving the app.
+app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY") or secrets.token_hex()
 sess = Session()
 sess.init_app(app)
+sock = Sock(app)
 app.jinja_env.filters["url_decode"] = lambda url: unquote(url)
 
 
@@ -96,29 +258,332 @@ def serve():
     return render_template("index.html", url_prefix=PREFIX, greeting=greeting)
 
 
+# Longest time a "GET /job?wait=..." long poll may be held open.
+MAX_WAIT = 30
+
+# Lifetime of a "/job/events" stream, and the interval between keep-alives.
+EVENTS_TIMEOUT = 300
+KEEPALIVE_INTERVAL = 15
+
+# Event streams and long polls each hold one of the GUNICORN_THREADS threads
+# of a gunicorn worker while they wait.  At most WAITING_MAX of them (by
+# default, half the threads) wait at once, so that other requests, such as
+# the clients' POSTs, always find a free thread.  Beyond that, they are
+# answered with a 503, and the client tries again after Retry-After seconds.
+SERVER_THREADS = int(os.environ.get("GUNICORN_THREADS", 8))
+WAITING_MAX = int(os.environ.get("WAITING_MAX", max(1, SERVER_THREADS // 2)))
+WAITING_SLOTS = threading.BoundedSemaphore(WAITING_MAX)
+WAITING_RETRY_AFTER = 5
+
+
+def too_busy():
+    """The response to a wait refused for lack of threads."""
+    return (
+        {"error": "Too many clients waiting for results; please retry later."},
+        503,
+        {"Retry-After": str(WAITING_RETRY_AFTER)},
+    )
+
+
+def client_id():
+    """Return an id for the current client, stored in its Flask session."""
+    if "client_id" not in session:
+        session["client_id"] = str(uuid4())
+    return session["client_id"]
+
+
+def read_job_request():
+    """Return the image and parameters of a POSTed job.
+
+    The image can be sent in three ways:
+
+    * As the raw request body, with an image content type such as
+      "image/jpeg" or "image/png".  The parameters are passed as JSON in
+      the "params" query argument.
+    * As the "image" file of a multipart form, with the parameters as JSON in
+      the "params" form field.
+    * As a JSON body, ``{"image": <base64 string>, "params": {...}}``.
+
+    The first two avoid the base64 overhead, and the image bytes are handed
+    to the detector as they are.
+    """
+    if request.mimetype.startswith("image/"):
+        image = request.get_data()
+        params = json.loads(request.args.get("params", "{}"))
+    elif request.mimetype == "multipart/form-data":
+        image = request.files["image"].read()
+        params = json.loads(request.form.get("params", "{}"))
+    else:
+        body = request.get_json(silent=True)
+        if body is None:
+            raise ValueError(f"unsupported content type {request.mimetype!r}")
+        if not isinstance(body, dict):
+            raise ValueError("the body must be a JSON object")
+        image, params = body["image"], body.get("params", {})
+    if not isinstance(params, dict):
+        raise ValueError("params must be a JSON object")
+    return image, params
+
+
+@app.get(PREFIX + "job/events")
+def job_events():
+    """Push this client's finished jobs as Server-Sent Events.
+
+    Each message is a JSON object like the response of "GET /job".  The
+    stream is closed after EVENTS_TIMEOUT seconds so it does not hold a
+    server thread forever; the browser's EventSource reconnects by itself.
+    """
+    owner = client_id()
+    if not WAITING_SLOTS.acquire(blocking=False):
+        return too_busy()
+
+    def stream():
+        # Tell the client the stream is live, so it knows no proxy is
+        # buffering it.
+        yield "retry: 1000\nevent: ready\ndata: {}\n\n"
+        deadline = time.monotonic() + EVENTS_TIMEOUT
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            finished = RESULTS.collect_finished(
+                owner, timeout=min(remaining, KEEPALIVE_INTERVAL)
+            )
+            if finished:
+                data = {task_id: describe_job(ret) for task_id, ret in finished.items()}
+                yield f"data: {json.dumps(data)}\n\n"
+            else:
+                yield ": keep-alive\n\n"
+
+    response = Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # The server closes the response when the stream ends or the client
+    # goes away, even if the stream never started.
+    response.call_on_close(WAITING_SLOTS.release)
+    return response
+
+
+def describe_job(ret):
+    """Add the image URL to the state of a finished job.
+
+    Jobs run with ``"output": "boxes"`` have no image; their face rectangles
+    are already included in the state.
+    """
+    if ret["status"] == "done" and "result" not in ret:
+        ret["image_url"] = PREFIX + f"job/{ret['id']}/image"
+    return ret
+
+
 @app.route(PREFIX + "job", methods=["GET", "POST"])
 def job():
     """A job endpoint for receiving images and returning job results"""
 
     if request.method == "GET":
-        # De-queue and return any finished jobs
-
-        ret = {}
-        while True:
+        # Return this client's jobs that finished, or published a preview,
+        # since the last poll.  With "?wait=<seconds>", this is a long poll:
+        # if nothing has changed yet, the response is held until a job
+        # finishes or the time is up.
+        try:
+            wait = min(float(request.args.get("wait", 0)), MAX_WAIT)
+        except ValueError:
+            return {"error": "Invalid wait: must be a number of seconds"}, 400
+        if not wait > 0:
+            # Also the case of "nan"
+            finished = RESULTS.collect_finished(client_id())
+        elif WAITING_SLOTS.acquire(blocking=False):
             try:
-                task_id, result = RESULTS.get(block=False)
-                RESULTS.task_done()
-                ret[task_id] = result
-            except Empty:
-                break
-        return ret
+                finished = RESULTS.collect_finished(client_id(), timeout=wait)
+            finally:
+                WAITING_SLOTS.release()
+        else:
+            return too_busy()
+        return {task_id: describe_job(ret) for task_id, ret in finished.items()}
 
     if request.method == "POST":
         # Spawn a face detection task and an id
 
-        body = request.json
+        try:
+            image, params = read_job_request()
+        except (KeyError, ValueError) as e:
+            return {"error": f"Invalid job request: {e}"}, 400
+
+        # A new job supersedes this client's queued jobs for the same image,
+        # or for the same "group" if the client gives one (e.g. one group per
+        # image on the canvas).  Only the newest of them will run.  They are
+        # only cancelled once it is accepted, so a rejected job leaves the
+        # previous one to run.
+        digest = image_digest(image)
+        group = request.args.get("group", digest)
         task_id = str(uuid4())
-        t = threading.Thread(target=task, args=(task_id, body["image"], body["params"]))
-        t.start()
-
+        RESULTS.add(client_id(), task_id)
+
+        key = None
+        if CACHE is not None:
+            # Only final results are cached, so a progressive job can reuse
+            # the result of a plain one, and the other way around.
+            key = cache_key(
+                digest, {k: v for k, v in params.items() if k != "progressive"}
+            )
+            cached = CACHE.get(key)
+            if cached is not None:
+                RESULTS.supersede(client_id(), task_id, group)
+                RESULTS.finish(task_id, cached)
+                return {"id": task_id}
+
+        try:
+            submit_job(task_id, client_id(), image, params, key, group)
+        except QueueFull:
+            RESULTS.discard(task_id)
+            return (
+                {"error": "Too many jobs in progress; please retry later."},
+                429,
+                {"Retry-After": str(EXECUTOR.retry_after())},
+            )
+        RESULTS.supersede(client_id(), task_id, group)
         return {"id": task_id}
+
+
+@app.get(PREFIX + "stats")
+def stats():
+    """Report queue depth and wait times, for sizing the container."""
+    return {
+        **EXECUTOR.stats(),
+        "results": RESULTS.stats(),
+        "cache": CACHE.stats() if CACHE is not None else None,
+    }
+
+
+@app.get(PREFIX + "metrics")
+def prometheus_metrics():
+    """Report timings and queue statistics in the Prometheus text format."""
+    executor = EXECUTOR.stats()
+    lines = STAGE_SECONDS.render() + JOB_SECONDS.render() + PREVIEW_SECONDS.render()
+    lines += FRAME_SECONDS.render()
+    lines += metrics.gauge(
+        "detect_queue_depth", "Jobs waiting for a worker.", executor["queue_depth"]
+    )
+    lines += metrics.gauge(
+        "detect_jobs_running", "Jobs being run.", executor["running"]
+    )
+    lines += metrics.counter(
+        "detect_jobs_completed_total", "Jobs run to completion.",
+        executor["completed"],
+    )
+    lines += metrics.counter(
+        "detect_jobs_rejected_total", "Jobs rejected because the queue was full.",
+        executor["rejected"],
+    )
+    # Per-session figures, to check that sessions get a fair share
+    sessions = executor["sessions"]
+    lines += metrics.labelled_gauge(
+        "detect_session_queue_depth", "Jobs waiting for a worker, per session.",
+        "session", {label: s["queue_depth"] for label, s in sessions.items()},
+    )
+    lines += metrics.labelled_gauge(
+        "detect_session_jobs_running", "Jobs being run, per session.",
+        "session", {label: s["running"] for label, s in sessions.items()},
+    )
+    lines += metrics.labelled_gauge(
+        "detect_session_wait_seconds_mean",
+        "Mean time jobs waited for a worker, per session.",
+        "session", {label: s["wait_seconds_mean"] for label, s in sessions.items()},
+    )
+    if CACHE is not None:
+        cache = CACHE.stats()
+        lines += metrics.counter(
+            "detect_cache_hits_total", "Result cache hits.", cache["hits"]
+        )
+        lines += metrics.counter(
+            "detect_cache_misses_total", "Result cache misses.", cache["misses"]
+        )
+    return Response("\n".join(lines) + "\n", content_type=metrics.CONTENT_TYPE)
+
+
+@app.route(PREFIX + "job/<task_id>", methods=["GET", "DELETE"])
+def job_status(task_id):
+    """Return the state of one of this client's jobs, or cancel it"""
+    if request.method == "DELETE" and not RESULTS.cancel(client_id(), task_id):
+        return {"error": f"No such job: {task_id}"}, 404
+
+    ret = RESULTS.get(client_id(), task_id)
+    if ret is None:
+        return {"error": f"No such job: {task_id}"}, 404
+    return describe_job(ret)
+
+
+@app.get(PREFIX + "job/<task_id>/image")
+def job_image(task_id):
+    """Return the annotated image of one of this client's finished jobs"""
+    data = RESULTS.get_result(client_id(), task_id)
+    if not isinstance(data, bytes):
+        return {"error": f"No image for job: {task_id}"}, 404
+
+    # A job's result never changes, so the browser may cache it for as long
+    # as the server keeps it.
+    response = Response(data, mimetype="image/jpeg")
+    response.set_etag(task_id)
+    response.cache_control.private = True
+    response.cache_control.max_age = int(RESULTS.ttl)
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+
+# Video streams are processed on the gunicorn thread serving their
+# connection, which they hold for as long as they are open.  At most
+# STREAM_MAX run at once (by default, a quarter of GUNICORN_THREADS), and a
+# stream idle for STREAM_IDLE_TIMEOUT seconds is closed.  Keep STREAM_MAX
+# plus WAITING_MAX below GUNICORN_THREADS, so that other requests still find
+# a free thread.  Their frames share the DETECT_SLOTS of the jobs.
+STREAM_MAX = int(os.environ.get("STREAM_MAX", max(1, SERVER_THREADS // 4)))
+STREAM_IDLE_TIMEOUT = 30
+STREAM_SLOTS = threading.BoundedSemaphore(STREAM_MAX)
+
+
+@sock.route(PREFIX + "stream")
+def stream(ws):
+    """Detect and track faces in a stream of video frames, over a WebSocket.
+
+    The client sends each frame as a binary message holding an encoded image
+    (e.g. a JPEG), and gets back a JSON message with the faces, as returned
+    by FaceTracker.process().  It should wait for the answer before sending
+    the next frame, so frames never queue up on the server.  A text message
+    holding a JSON object changes the detection parameters and the stream
+    options (see FaceTracker.configure()).
+    """
+    if not STREAM_SLOTS.acquire(blocking=False):
+        ws.send(json.dumps({"error": "Too many streams; please retry later."}))
+        # 1013: "Try Again Later"
+        ws.close(reason=1013)
+        return
+
+    tracker = FaceTracker()
+    try:
+        while True:
+            data = ws.receive(timeout=STREAM_IDLE_TIMEOUT)
+            if data is None:
+                break
+            if isinstance(data, str):
+                try:
+                    tracker.configure(json.loads(data))
+                except (AttributeError, TypeError, ValueError) as e:
+                    ws.send(json.dumps({"error": f"Invalid stream options: {e}"}))
+                continue
+
+            timings = {}
+            start = time.perf_counter()
+            try:
+                with DETECT_SLOTS:
+                    result = tracker.process(data, timings)
+            except Exception as e:
+                ws.send(json.dumps({"error": str(e)}))
+                continue
+            FRAME_SECONDS.observe(time.perf_counter() - start)
+            result["timings"] = timings
+            ws.send(json.dumps(result))
+    except ConnectionClosed:
+        pass
+    finally:
+        STREAM_SLOTS.release()
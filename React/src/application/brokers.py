@@ -0,0 +1,946 @@
+# Enthought product code
+#
+# (C) Copyright 2010-2022 Enthought, Inc., Austin, TX
+# All rights reserved.
+#
+# This file and its contents are confidential information and NOT open source.
+# Distribution is prohibited.
+
+"""
+    Job brokers, which share the job queue and job results between processes.
+
+    By default, the React example keeps its jobs in process memory (see
+    ResultStore and JobExecutor in "jobs.py"), so it must run as a single
+    gunicorn worker.  A broker moves the queue and the results out of the
+    process, so that a job POSTed to one worker can be run by, and polled
+    from, any other:
+
+    * SQLiteBroker keeps them in a SQLite database file, shared by the
+      processes on one host.
+    * RedisBroker keeps them in a Redis server (or anything speaking the
+      Redis protocol), shared by any number of pods.
+
+    Use make_broker() to create one from a URL.
+"""
+
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from .jobs import OwnerStats, QueueFull, cpu_quota, describe_task, result_size
+
+FINISHED = ("done", "failed", "cancelled")
+
+
+def make_broker(url, ttl=600, max_bytes=256 * 1024 * 1024):
+    """Create a broker from a URL.
+
+    "sqlite:///path/to/jobs.sqlite" creates a SQLiteBroker, and
+    "redis://host:port/db" a RedisBroker.
+    """
+    scheme = urlparse(url).scheme
+    if scheme == "sqlite":
+        return SQLiteBroker(url[len("sqlite:///"):], ttl=ttl, max_bytes=max_bytes)
+    if scheme in ("redis", "rediss", "unix"):
+        # Only needed for this backend
+        import redis
+
+        return RedisBroker(redis.Redis.from_url(url), ttl=ttl, max_bytes=max_bytes)
+    raise ValueError(f"Unsupported job broker URL: {url!r}")
+
+
+class Broker:
+    """The interface of a job broker.
+
+    The methods for task state are those of ResultStore, with the same
+    meaning.  In addition, a broker holds the queue of jobs waiting to run.
+    """
+
+    ttl = 600
+
+    def add(self, owner, task_id, group=None):
+        raise NotImplementedError()
+
+    def supersede(self, owner, task_id, group):
+        raise NotImplementedError()
+
+    def start(self, task_id):
+        raise NotImplementedError()
+
+    def finish(self, task_id, result, timings=None):
+        raise NotImplementedError()
+
+    def update(self, task_id, result, timings=None):
+        raise NotImplementedError()
+
+    def fail(self, task_id, error):
+        raise NotImplementedError()
+
+    def cancel(self, owner, task_id):
+        raise NotImplementedError()
+
+    def discard(self, task_id):
+        raise NotImplementedError()
+
+    def get(self, owner, task_id):
+        raise NotImplementedError()
+
+    def get_result(self, owner, task_id):
+        raise NotImplementedError()
+
+    def collect_finished(self, owner, timeout=0):
+        raise NotImplementedError()
+
+    def stats(self):
+        raise NotImplementedError()
+
+    def put_job(self, task_id, image, params, key=None):
+        """Queue the input of a task added with add()."""
+        raise NotImplementedError()
+
+    def take_job(self, timeout, max_per_owner=None):
+        """Take a queued job, waiting up to ``timeout`` seconds.
+
+        Owners take turns: the job is the oldest of the owner that least
+        recently had a job taken, among the owners with fewer than
+        ``max_per_owner`` jobs running.
+
+        Returns a tuple ``(task_id, owner, image, params, key, queued_at)``,
+        or None.
+        """
+        raise NotImplementedError()
+
+    def queue_depth(self, owner=None):
+        """Return the number of jobs waiting to run, for ``owner`` if given."""
+        raise NotImplementedError()
+
+
+def _encode_payload(image):
+    """Return the bytes of a job's image, and whether they are base64."""
+    if isinstance(image, str):
+        return image.encode("ascii"), True
+    return bytes(image), False
+
+
+def _decode_payload(data, is_base64):
+    return data.decode("ascii") if is_base64 else data
+
+
+class SQLiteBroker(Broker):
+    """A broker backed by a SQLite database, for processes on one host.
+
+    Waiting for jobs and results is done by polling the database every
+    ``poll_interval`` seconds.  Polls only read, and only take the write
+    lock when there is something to take; expired entries are hidden at
+    once, but only deleted every ``expire_interval`` seconds.
+    """
+
+    def __init__(self, path, ttl=600, max_bytes=256 * 1024 * 1024,
+                 poll_interval=0.05, expire_interval=5):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.poll_interval = poll_interval
+        self.expire_interval = expire_interval
+        self._next_expiry = 0.0
+        self._local = threading.local()
+        with self._transaction() as db:
+            db.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    task_id TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    grp TEXT,
+                    status TEXT NOT NULL,
+                    queued REAL,
+                    started REAL,
+                    finished REAL,
+                    reported INTEGER NOT NULL DEFAULT 1,
+                    version INTEGER NOT NULL DEFAULT 0,
+                    size INTEGER NOT NULL DEFAULT 0,
+                    result BLOB,
+                    result_json TEXT,
+                    error TEXT,
+                    timings TEXT,
+                    payload BLOB,
+                    payload_b64 INTEGER,
+                    params TEXT,
+                    cache_key TEXT
+                )"""
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner, status)")
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_queued ON jobs (queued) "
+                "WHERE queued IS NOT NULL"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished) "
+                "WHERE finished IS NOT NULL"
+            )
+            # Jobs taken and not finished, and the last time one was taken,
+            # per owner, so take_job() need not scan every job.
+            db.execute(
+                """CREATE TABLE IF NOT EXISTS owners (
+                    owner TEXT PRIMARY KEY,
+                    running INTEGER NOT NULL DEFAULT 0,
+                    last_started REAL NOT NULL DEFAULT 0
+                )"""
+            )
+
+    def _db(self):
+        # One connection per thread
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def add(self, owner, task_id, group=None):
+        with self._transaction() as db:
+            db.execute(
+                "INSERT INTO jobs (task_id, owner, status) VALUES (?, ?, 'pending')",
+                (task_id, owner),
+            )
+            if group is not None:
+                self._supersede(db, owner, task_id, group)
+
+    def supersede(self, owner, task_id, group):
+        with self._transaction() as db:
+            self._supersede(db, owner, task_id, group)
+
+    @staticmethod
+    def _supersede(db, owner, task_id, group):
+        db.execute(
+            "UPDATE jobs SET status = 'cancelled', error = ?, finished = ?, "
+            "queued = NULL, payload = NULL, reported = 0 "
+            "WHERE owner = ? AND grp = ? AND status = 'pending' AND task_id != ?",
+            ("Superseded by a newer job", time.time(), owner, group, task_id),
+        )
+        db.execute(
+            "UPDATE jobs SET grp = ? WHERE task_id = ? AND status = 'pending'",
+            (group, task_id),
+        )
+
+    def start(self, task_id):
+        cursor = self._db().execute(
+            "UPDATE jobs SET status = 'running' "
+            "WHERE task_id = ? AND status = 'pending'",
+            (task_id,),
+        )
+        return cursor.rowcount == 1
+
+    def finish(self, task_id, result, timings=None):
+        if isinstance(result, dict):
+            blob, result_json = None, json.dumps(result)
+        else:
+            blob, result_json = result, None
+        self._set_finished(
+            task_id, "done", blob, result_json, None, result_size(result), timings
+        )
+
+    def update(self, task_id, result, timings=None):
+        if isinstance(result, dict):
+            blob, result_json = None, json.dumps(result)
+        else:
+            blob, result_json = result, None
+        cursor = self._db().execute(
+            "UPDATE jobs SET result = ?, result_json = ?, timings = ?, "
+            "version = version + 1, reported = 0 "
+            "WHERE task_id = ? AND status = 'running'",
+            (
+                blob, result_json,
+                None if timings is None else json.dumps(timings), task_id,
+            ),
+        )
+        return cursor.rowcount == 1
+
+    def fail(self, task_id, error):
+        self._set_finished(task_id, "failed", None, None, error, 0, None)
+
+    def cancel(self, owner, task_id):
+        row = self._db().execute(
+            "SELECT owner FROM jobs WHERE task_id = ?", (task_id,)
+        ).fetchone()
+        if row is None or row[0] != owner:
+            return False
+        self._set_finished(task_id, "cancelled", None, None, "Cancelled", 0, None)
+        return True
+
+    def discard(self, task_id):
+        self._db().execute("DELETE FROM jobs WHERE task_id = ?", (task_id,))
+
+    def get(self, owner, task_id):
+        self._expire()
+        row = self._db().execute(
+            "SELECT status, result_json, error, timings, version FROM jobs "
+            "WHERE task_id = ? AND owner = ? AND (finished IS NULL OR finished >= ?)",
+            (task_id, owner, time.time() - self.ttl),
+        ).fetchone()
+        return None if row is None else self._describe(task_id, *row)
+
+    def get_result(self, owner, task_id):
+        self._expire()
+        row = self._db().execute(
+            "SELECT result, result_json FROM jobs "
+            "WHERE task_id = ? AND owner = ? AND (finished IS NULL OR finished >= ?)",
+            (task_id, owner, time.time() - self.ttl),
+        ).fetchone()
+        if row is None:
+            return None
+        if row[1] is not None:
+            return json.loads(row[1])
+        return row[0]
+
+    def collect_finished(self, owner, timeout=0):
+        deadline = time.monotonic() + timeout
+        query = (
+            "SELECT task_id, status, result_json, error, timings, version "
+            "FROM jobs WHERE owner = ? AND reported = 0"
+        )
+        while True:
+            self._expire()
+            # Look before taking the write lock, to keep idle polling cheap.
+            rows = self._db().execute(query, (owner,)).fetchall()
+            if rows:
+                with self._transaction() as db:
+                    rows = db.execute(query, (owner,)).fetchall()
+                    db.executemany(
+                        "UPDATE jobs SET reported = 1 WHERE task_id = ?",
+                        [(row[0],) for row in rows],
+                    )
+            if rows or time.monotonic() >= deadline:
+                return {row[0]: self._describe(*row) for row in rows}
+            time.sleep(self.poll_interval)
+
+    def stats(self):
+        entries, finished, size = self._db().execute(
+            "SELECT COUNT(*), COUNT(finished), COALESCE(SUM(size), 0) FROM jobs"
+        ).fetchone()
+        return {
+            "entries": entries,
+            "finished": finished,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+        }
+
+    def put_job(self, task_id, image, params, key=None):
+        payload, is_base64 = _encode_payload(image)
+        self._db().execute(
+            "UPDATE jobs SET payload = ?, payload_b64 = ?, params = ?, cache_key = ?, "
+            "queued = ? WHERE task_id = ? AND status = 'pending'",
+            (payload, is_base64, json.dumps(params), key, time.time(), task_id),
+        )
+
+    def take_job(self, timeout, max_per_owner=None):
+        deadline = time.monotonic() + timeout
+        # The owners take turns in order of the last time one of their jobs
+        # was taken.  Only queued jobs are scanned.
+        query = """
+            SELECT j.task_id, j.owner, j.payload, j.payload_b64, j.params,
+                   j.cache_key, j.queued
+            FROM jobs j LEFT JOIN owners o ON o.owner = j.owner
+            WHERE j.queued IS NOT NULL AND j.status = 'pending'
+                  AND COALESCE(o.running, 0) < ?
+            ORDER BY COALESCE(o.last_started, 0), j.queued LIMIT 1
+        """
+        args = (max_per_owner or 2 ** 31,)
+        while True:
+            # Look before taking the write lock, to keep idle polling cheap.
+            if self._db().execute(query, args).fetchone() is not None:
+                with self._transaction() as db:
+                    row = db.execute(query, args).fetchone()
+                    if row is not None:
+                        now = time.time()
+                        db.execute(
+                            "UPDATE jobs SET queued = NULL, payload = NULL, "
+                            "started = ? WHERE task_id = ?",
+                            (now, row[0]),
+                        )
+                        db.execute(
+                            "INSERT INTO owners (owner, running, last_started) "
+                            "VALUES (?, 1, ?) ON CONFLICT (owner) DO UPDATE SET "
+                            "running = running + 1, "
+                            "last_started = excluded.last_started",
+                            (row[1], now),
+                        )
+                if row is not None:
+                    task_id, owner, payload, is_base64, params, key, queued = row
+                    image = _decode_payload(payload, is_base64)
+                    return task_id, owner, image, json.loads(params), key, queued
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def queue_depth(self, owner=None):
+        query = "SELECT COUNT(*) FROM jobs WHERE queued IS NOT NULL AND status = 'pending'"
+        if owner is None:
+            return self._db().execute(query).fetchone()[0]
+        return self._db().execute(query + " AND owner = ?", (owner,)).fetchone()[0]
+
+    def _set_finished(self, task_id, status, result, result_json, error, size,
+                      timings):
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT owner, started FROM jobs "
+                "WHERE task_id = ? AND status IN ('pending', 'running')",
+                (task_id,),
+            ).fetchone()
+            if row is None:
+                # Removed, or already finished
+                return
+            if row[1] is not None:
+                db.execute(
+                    "UPDATE owners SET running = running - 1 WHERE owner = ?",
+                    (row[0],),
+                )
+            db.execute(
+                "UPDATE jobs SET status = ?, result = ?, result_json = ?, error = ?, "
+                "size = ?, timings = ?, finished = ?, queued = NULL, payload = NULL, "
+                "reported = 0, version = version + ? "
+                "WHERE task_id = ? AND status IN ('pending', 'running')",
+                (
+                    status, result, result_json, error, size,
+                    None if timings is None else json.dumps(timings),
+                    time.time(), int(status == "done"), task_id,
+                ),
+            )
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM jobs").fetchone()[0]
+            if total > self.max_bytes:
+                # Evict the oldest finished results
+                for old_id, old_size in db.execute(
+                    "SELECT task_id, size FROM jobs WHERE finished IS NOT NULL "
+                    "ORDER BY finished"
+                ).fetchall():
+                    db.execute("DELETE FROM jobs WHERE task_id = ?", (old_id,))
+                    total -= old_size
+                    if total <= self.max_bytes:
+                        break
+
+    def _expire(self):
+        if time.monotonic() < self._next_expiry:
+            return
+        self._next_expiry = time.monotonic() + self.expire_interval
+        with self._transaction() as db:
+            expired = time.time() - self.ttl
+            db.execute("DELETE FROM jobs WHERE finished < ?", (expired,))
+            db.execute(
+                "DELETE FROM owners WHERE running <= 0 AND last_started < ?",
+                (expired,),
+            )
+
+    @staticmethod
+    def _describe(task_id, status, result_json, error, timings, version):
+        return describe_task(
+            task_id,
+            status,
+            None if result_json is None else json.loads(result_json),
+            error,
+            None if timings is None else json.loads(timings),
+            version,
+        )
+
+
+class RedisBroker(Broker):
+    """A broker backed by a Redis server, for any number of hosts.
+
+    ``client`` is a redis.Redis client; any server speaking the Redis
+    protocol will do, including an in-process stand-in for testing.
+    """
+
+    def __init__(self, client, ttl=600, max_bytes=256 * 1024 * 1024,
+                 prefix="edge-react:"):
+        self.client = client
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+
+    def _key(self, *parts):
+        return self.prefix + ":".join(parts)
+
+    def add(self, owner, task_id, group=None):
+        pipe = self.client.pipeline()
+        pipe.hset(
+            self._key("job", task_id), mapping={"owner": owner, "status": "pending"}
+        )
+        pipe.sadd(self._key("owner", owner), task_id)
+        pipe.execute()
+        if group is not None:
+            self.supersede(owner, task_id, group)
+
+    def supersede(self, owner, task_id, group):
+        group_key = self._key("group", owner, group)
+        for old_id in self.client.smembers(group_key):
+            if old_id.decode() != task_id:
+                self._set_finished(
+                    old_id.decode(), "cancelled", error="Superseded by a newer job"
+                )
+        job_key = self._key("job", task_id)
+
+        def join(pipe):
+            if pipe.hget(job_key, "status") != b"pending":
+                return
+            pipe.multi()
+            pipe.hset(job_key, "group", group)
+            pipe.sadd(group_key, task_id)
+
+        self.client.transaction(join, job_key)
+
+    def start(self, task_id):
+        job_key = self._key("job", task_id)
+
+        def start(pipe):
+            status, owner, group = pipe.hmget(job_key, "status", "owner", "group")
+            if status != b"pending":
+                return False
+            pipe.multi()
+            pipe.hset(job_key, "status", "running")
+            if group is not None:
+                pipe.srem(self._key("group", owner.decode(), group.decode()), task_id)
+            return True
+
+        return self.client.transaction(start, job_key, value_from_callable=True)
+
+    def finish(self, task_id, result, timings=None):
+        self._set_finished(task_id, "done", result=result, timings=timings)
+
+    def update(self, task_id, result, timings=None):
+        job_key = self._key("job", task_id)
+
+        def update(pipe):
+            status, owner = pipe.hmget(job_key, "status", "owner")
+            if status != b"running":
+                return False
+            mapping = {}
+            if timings is not None:
+                mapping["timings"] = json.dumps(timings)
+            pipe.multi()
+            if isinstance(result, dict):
+                mapping["result_json"] = json.dumps(result)
+            else:
+                pipe.hdel(job_key, "result_json")
+                pipe.set(self._key("result", task_id), result)
+            if mapping:
+                pipe.hset(job_key, mapping=mapping)
+            pipe.hincrby(job_key, "version", 1)
+            self._notify(pipe, owner.decode(), task_id)
+            return True
+
+        return self.client.transaction(update, job_key, value_from_callable=True)
+
+    def fail(self, task_id, error):
+        self._set_finished(task_id, "failed", error=error)
+
+    def cancel(self, owner, task_id):
+        if self.client.hget(self._key("job", task_id), "owner") != owner.encode():
+            return False
+        self._set_finished(task_id, "cancelled", error="Cancelled")
+        return True
+
+    def discard(self, task_id):
+        self._delete(task_id)
+
+    def get(self, owner, task_id):
+        self._expire()
+        return self._read(owner, task_id)
+
+    def get_result(self, owner, task_id):
+        self._expire()
+        job_key = self._key("job", task_id)
+        job_owner, result_json = self.client.hmget(job_key, "owner", "result_json")
+        if job_owner != owner.encode():
+            return None
+        if result_json is not None:
+            return json.loads(result_json)
+        return self.client.get(self._key("result", task_id))
+
+    def collect_finished(self, owner, timeout=0):
+        deadline = time.monotonic() + timeout
+        unreported_key = self._key("unreported", owner)
+        while True:
+            self._expire()
+            pipe = self.client.pipeline()
+            pipe.smembers(unreported_key)
+            pipe.delete(unreported_key)
+            task_ids, _ = pipe.execute()
+            ret = {}
+            for task_id in task_ids:
+                state = self._read(owner, task_id.decode())
+                if state is not None:
+                    ret[state["id"]] = state
+            remaining = deadline - time.monotonic()
+            if ret or remaining <= 0:
+                return ret
+            # Sleep until a task of this owner finishes.  Only one waiter is
+            # woken up per task, so others check again after a second.
+            self.client.blpop([self._key("notify", owner)], timeout=1)
+
+    def stats(self):
+        pipe = self.client.pipeline()
+        pipe.zcard(self._key("finished"))
+        pipe.get(self._key("bytes"))
+        finished, size = pipe.execute()
+        return {
+            "finished": finished,
+            "bytes": int(size or 0),
+            "max_bytes": self.max_bytes,
+        }
+
+    def put_job(self, task_id, image, params, key=None):
+        # Each owner has a queue, and the owners with queued jobs take turns
+        # in the "turns" list, which take_job() rotates.
+        owner = self.client.hget(self._key("job", task_id), "owner").decode()
+        payload, is_base64 = _encode_payload(image)
+        mapping = {
+            "payload_b64": int(is_base64),
+            "params": json.dumps(params),
+            "queued": time.time(),
+        }
+        if key is not None:
+            mapping["cache_key"] = key
+        pipe = self.client.pipeline()
+        pipe.set(self._key("payload", task_id), payload)
+        pipe.hset(self._key("job", task_id), mapping=mapping)
+        pipe.lpush(self._key("queue", owner), task_id)
+        pipe.incr(self._key("queued"))
+        pipe.execute()
+        if self.client.sadd(self._key("owners"), owner):
+            self.client.lpush(self._key("turns"), owner)
+        self._wake()
+
+    def take_job(self, timeout, max_per_owner=None):
+        deadline = time.monotonic() + timeout
+        turns_key = self._key("turns")
+        skipped = set()
+        while True:
+            owner = self.client.rpoplpush(turns_key, turns_key)
+            if owner is None or owner in skipped:
+                # Every owner with queued jobs is at its limit, or there are
+                # none: wait for a job to be queued or to finish.
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.client.blpop([self._key("wake")], timeout=1)
+                skipped.clear()
+                continue
+
+            owner = owner.decode()
+            running_key = self._key("running", owner)
+            running = int(self.client.get(running_key) or 0)
+            if max_per_owner and running >= max_per_owner:
+                skipped.add(owner.encode())
+                continue
+
+            queue_key = self._key("queue", owner)
+            task_id = self.client.rpop(queue_key)
+            if task_id is None:
+                self._retire_owner(owner)
+                continue
+            self.client.decr(self._key("queued"))
+
+            task_id = task_id.decode()
+            job_key = self._key("job", task_id)
+            payload_key = self._key("payload", task_id)
+
+            def claim(pipe):
+                # Check that the job is still pending and mark it as taken in
+                # one transaction, so that a job cancelled in between is
+                # either not taken, or counted as running when it finishes.
+                fields = pipe.hmget(
+                    job_key, "status", "payload_b64", "params", "cache_key", "queued"
+                )
+                payload = pipe.get(payload_key)
+                if fields[0] != b"pending" or payload is None:
+                    return None
+                pipe.multi()
+                pipe.delete(payload_key)
+                pipe.hset(job_key, "started", time.time())
+                pipe.incr(running_key)
+                # Don't leak the count if a process dies while running the job
+                pipe.expire(running_key, int(self.ttl))
+                return fields[1:], payload
+
+            claimed = self.client.transaction(claim, job_key, value_from_callable=True)
+            if claimed is None:
+                # Cancelled or superseded while it was queued
+                continue
+            (is_base64, params, key, queued), payload = claimed
+            return (
+                task_id,
+                owner,
+                _decode_payload(payload, is_base64 == b"1"),
+                json.loads(params),
+                None if key is None else key.decode(),
+                float(queued),
+            )
+
+    def queue_depth(self, owner=None):
+        if owner is None:
+            return max(0, int(self.client.get(self._key("queued")) or 0))
+        return self.client.llen(self._key("queue", owner))
+
+    def _retire_owner(self, owner):
+        # Take an owner with an empty queue out of the turns, unless a job
+        # is queued for it in the meantime.
+        queue_key = self._key("queue", owner)
+
+        def retire(pipe):
+            if pipe.llen(queue_key):
+                return
+            pipe.multi()
+            pipe.lrem(self._key("turns"), 0, owner)
+            pipe.srem(self._key("owners"), owner)
+
+        self.client.transaction(retire, queue_key)
+
+    def _wake(self):
+        # Wake up a worker waiting in take_job()
+        wake_key = self._key("wake")
+        pipe = self.client.pipeline()
+        pipe.rpush(wake_key, 1)
+        pipe.ltrim(wake_key, 0, 63)
+        pipe.execute()
+
+    def _set_finished(self, task_id, status, result=None, error=None, timings=None):
+        job_key = self._key("job", task_id)
+        size = 0 if result is None else result_size(result)
+
+        def finish(pipe):
+            current, owner, group, started = pipe.hmget(
+                job_key, "status", "owner", "group", "started"
+            )
+            if current not in (b"pending", b"running"):
+                return None
+            owner = owner.decode()
+            mapping = {"status": status, "size": size}
+            if error is not None:
+                mapping["error"] = error
+            if timings is not None:
+                mapping["timings"] = json.dumps(timings)
+            if isinstance(result, dict):
+                mapping["result_json"] = json.dumps(result)
+
+            pipe.multi()
+            pipe.hset(job_key, mapping=mapping)
+            if not isinstance(result, dict):
+                # Drop any preliminary result published by update()
+                pipe.hdel(job_key, "result_json")
+            if result is not None and not isinstance(result, dict):
+                pipe.set(self._key("result", task_id), result)
+            if status == "done":
+                pipe.hincrby(job_key, "version", 1)
+            pipe.delete(self._key("payload", task_id))
+            if group is not None:
+                pipe.srem(self._key("group", owner, group.decode()), task_id)
+            pipe.zadd(self._key("finished"), {task_id: time.time()})
+            pipe.incrby(self._key("bytes"), size)
+            self._notify(pipe, owner, task_id)
+            if started is not None:
+                pipe.decr(self._key("running", owner))
+            return owner
+
+        owner = self.client.transaction(finish, job_key, value_from_callable=True)
+        if owner is not None:
+            # Take a job cancelled while queued out of its owner's queue, so
+            # it no longer counts against the queue limits.  Whichever of
+            # this and take_job() removes it accounts for it.
+            if self.client.lrem(self._key("queue", owner), 0, task_id):
+                self.client.decr(self._key("queued"))
+            self._wake()
+            self._evict()
+
+    def _notify(self, pipe, owner, task_id):
+        # Report the task's new state to the owner, and wake up one client
+        # waiting in collect_finished().
+        pipe.sadd(self._key("unreported", owner), task_id)
+        notify_key = self._key("notify", owner)
+        pipe.rpush(notify_key, 1)
+        pipe.ltrim(notify_key, 0, 0)
+        pipe.expire(notify_key, int(self.ttl))
+
+    def _read(self, owner, task_id):
+        fields = self.client.hmget(
+            self._key("job", task_id),
+            "owner", "status", "result_json", "error", "timings", "version",
+        )
+        job_owner, status, result_json, error, timings, version = fields
+        if job_owner != owner.encode():
+            return None
+        return describe_task(
+            task_id,
+            status.decode(),
+            None if result_json is None else json.loads(result_json),
+            None if error is None else error.decode(),
+            None if timings is None else json.loads(timings),
+            int(version or 0),
+        )
+
+    def _evict(self):
+        while int(self.client.get(self._key("bytes")) or 0) > self.max_bytes:
+            oldest = self.client.zpopmin(self._key("finished"))
+            if not oldest:
+                break
+            self._delete(oldest[0][0].decode(), evicted=True)
+
+    def _expire(self):
+        for task_id in self.client.zrangebyscore(
+            self._key("finished"), 0, time.time() - self.ttl
+        ):
+            self._delete(task_id.decode())
+
+    def _delete(self, task_id, evicted=False):
+        job_key = self._key("job", task_id)
+        owner, size = self.client.hmget(job_key, "owner", "size")
+        # Only one process gets to account for the removal of each entry.
+        removed = evicted or self.client.zrem(self._key("finished"), task_id)
+        pipe = self.client.pipeline()
+        pipe.delete(job_key, self._key("result", task_id), self._key("payload", task_id))
+        if owner is not None:
+            pipe.srem(self._key("owner", owner.decode()), task_id)
+            pipe.srem(self._key("unreported", owner.decode()), task_id)
+        if removed and size is not None:
+            pipe.decrby(self._key("bytes"), int(size))
+        pipe.execute()
+
+
+class BrokerWorkers:
+    """Worker threads that run the jobs queued in a broker.
+
+    This has the same submit/retry_after/stats interface as JobExecutor,
+    but the queue lives in the broker, so a job submitted by one process can
+    be run by the worker threads of any other.  ``handler`` is called as
+    ``handler(task_id, image, params, key)`` for each job.
+
+    As with JobExecutor, owners take turns, and ``max_per_owner`` and
+    ``max_queued_per_owner`` limit their running and queued jobs; both
+    limits count the jobs of every process sharing the broker.
+    """
+
+    def __init__(self, broker, handler, max_workers=None, max_queued=None,
+                 max_per_owner=None, max_queued_per_owner=None):
+        self.broker = broker
+        self.handler = handler
+        self.max_workers = max_workers or cpu_quota()
+        if max_queued is None:
+            max_queued = 4 * self.max_workers
+        self.max_queued = max_queued
+        self.max_per_owner = max_per_owner or self.max_workers
+        self.max_queued_per_owner = max_queued_per_owner or self.max_queued
+
+        self._lock = threading.Lock()
+        self._running = 0
+        self._completed = 0
+        self._rejected = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._run_total = 0.0
+        self._owner_stats = OwnerStats()
+        self._stopping = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._work, name=f"job-{i}", daemon=True)
+            for i in range(self.max_workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, task_id, owner, image, params, key=None):
+        """Queue a job of ``owner`` in the broker.
+
+        Raises QueueFull if the broker already holds ``max_queued`` jobs, or
+        ``max_queued_per_owner`` jobs of this owner.
+        """
+        if (
+            self.broker.queue_depth() >= self.max_queued
+            or self.broker.queue_depth(owner) >= self.max_queued_per_owner
+        ):
+            with self._lock:
+                self._rejected += 1
+            self._owner_stats.rejected(owner)
+            raise QueueFull()
+        self.broker.put_job(task_id, image, params, key)
+
+    def retry_after(self):
+        """Estimate how many seconds a rejected client should wait."""
+        backlog = self.broker.queue_depth()
+        with self._lock:
+            if self._completed == 0:
+                return 1
+            mean_run = self._run_total / self._completed
+            backlog += self._running
+        return max(1, math.ceil(mean_run * backlog / self.max_workers))
+
+    def stats(self):
+        """Return a snapshot of queue depth and wait time statistics.
+
+        Apart from the queue depth, these are for this process's workers;
+        in particular, the "sessions" statistics do not include queue depths.
+        """
+        queue_depth = self.broker.queue_depth()
+        with self._lock:
+            started = self._completed + self._running
+            return {
+                "workers": self.max_workers,
+                "queue_capacity": self.max_queued,
+                "queue_depth": queue_depth,
+                "running": self._running,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "wait_seconds_mean": (
+                    self._wait_total / started if started else 0.0
+                ),
+                "wait_seconds_max": self._wait_max,
+                "max_per_session": self.max_per_owner,
+                "sessions": self._owner_stats.snapshot(),
+                "pid": os.getpid(),
+            }
+
+    def shutdown(self, wait=True):
+        """Stop taking jobs from the broker."""
+        self._stopping.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _work(self):
+        while not self._stopping.is_set():
+            try:
+                job = self.broker.take_job(timeout=1, max_per_owner=self.max_per_owner)
+            except Exception:
+                # E.g. the broker is restarting; try again shortly.
+                time.sleep(1)
+                continue
+            if job is None:
+                continue
+
+            task_id, owner, image, params, key, queued = job
+            started = time.monotonic()
+            waited = max(0.0, time.time() - queued)
+            with self._lock:
+                self._running += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+            self._owner_stats.started(owner, waited)
+            try:
+                self.handler(task_id, image, params, key)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._completed += 1
+                    self._run_total += time.monotonic() - started
+                self._owner_stats.finished(owner)
@@ -0,0 +1,167 @@
+# Enthought product code
+#
+# (C) Copyright 2010-2022 Enthought, Inc., Austin, TX
+# All rights reserved.
+#
+# This file and its contents are confidential information and NOT open source.
+# Distribution is prohibited.
+
+"""
+    Content-addressed cache of face detection results.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from .jobs import result_size
+
+
+def image_digest(image):
+    """Return a hash of the content of an encoded image."""
+    if isinstance(image, str):
+        image = image.encode("ascii")
+    return hashlib.sha256(image).hexdigest()
+
+
+def cache_key(digest, params):
+    """Return the cache key for detecting faces with ``params``.
+
+    The key combines the image_digest() of the image with the parameters, so
+    the same image uploaded twice with the same settings gives the same key.
+    """
+    return digest + ":" + json.dumps(params, sort_keys=True)
+
+
+class ResultCache:
+    """A least-recently-used cache of results, with a memory budget.
+
+    When ``spill_dir`` is given, entries evicted from memory are written
+    there, up to ``max_disk_bytes``, and are moved back into memory on their
+    next use.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, spill_dir=None,
+                 max_disk_bytes=1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_disk_bytes = max_disk_bytes
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # key -> (result, size), least recently used first
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        # key -> size, for spilled entries, least recently used first
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key):
+        """Return the cached result for ``key``, or None."""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._hits += 1
+                return self._memory[key][0]
+            if key not in self._disk:
+                self._misses += 1
+                return None
+            self._disk_bytes -= self._disk.pop(key)
+
+        try:
+            with open(self._path(key), "rb") as f:
+                kind = f.read(1)
+                result = f.read()
+            os.remove(self._path(key))
+            if kind == b"j":
+                result = json.loads(result)
+        except (OSError, ValueError):
+            with self._lock:
+                self._misses += 1
+            return None
+
+        with self._lock:
+            self._hits += 1
+            self._disk_hits += 1
+        self.put(key, result)
+        return result
+
+    def put(self, key, result):
+        """Store ``result`` under ``key``."""
+        size = result_size(result)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._memory[key] = (result, size)
+            self._memory_bytes += size
+            evicted = []
+            while self._memory_bytes > self.max_bytes:
+                old_key, (old_result, old_size) = self._memory.popitem(last=False)
+                self._memory_bytes -= old_size
+                self._evictions += 1
+                evicted.append((old_key, old_result))
+
+        if self.spill_dir is not None:
+            for old_key, old_result in evicted:
+                self._spill(old_key, old_result)
+
+    def stats(self):
+        """Return hit/miss counters and sizes."""
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "disk_hits": self._disk_hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "entries": len(self._memory),
+                "bytes": self._memory_bytes,
+                "max_bytes": self.max_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def _spill(self, key, result):
+        # The first byte of the file tells binary and JSON results apart.
+        if isinstance(result, dict):
+            kind, data = b"j", json.dumps(result).encode("utf-8")
+        else:
+            kind, data = b"b", result
+        if len(data) > self.max_disk_bytes:
+            return
+        try:
+            with open(self._path(key), "wb") as f:
+                f.write(kind)
+                f.write(data)
+        except OSError:
+            return
+
+        removed = []
+        with self._lock:
+            if key in self._disk:
+                self._disk_bytes -= self._disk.pop(key)
+            self._disk[key] = len(data)
+            self._disk_bytes += len(data)
+            while self._disk_bytes > self.max_disk_bytes:
+                old_key, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                removed.append(old_key)
+
+        for old_key in removed:
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+
+    def _path(self, key):
+        name = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.spill_dir, name)
@@ -3,11 +3,15 @@ import "bootstrap/dist/css/bootstrap.min.css";
 
 import Konva from "konva";
 import React, { Component } from "react";
+import Button from "react-bootstrap/Button";
 import Col from "react-bootstrap/Col";
 import Form from "react-bootstrap/Form";
 import Navbar from "react-bootstrap/Navbar";
 import Row from "react-bootstrap/Row";
 
+import { resizeForUpload } from "./resize";
+import { FrameStream, IStreamResult } from "./stream";
+
 interface IParams {
   label: string;
   value: number;
@@ -20,12 +24,52 @@ interface ILog {
   time: string;
   content: string;
 }
+interface IFaceBoxes {
+  width: number;
+  height: number;
+  faces: [number, number, number, number][];
+}
+
+interface IJobResult {
+  id: string;
+  status: "pending" | "running" | "done" | "failed" | "cancelled";
+  // Number of results published so far; a running task may publish a
+  // preview before its final result.
+  version?: number;
+  image_url?: string;
+  result?: IFaceBoxes;
+  error?: string;
+  timings?: { [stage: string]: number };
+}
+
+interface ICanvasImage {
+  file: File;
+  konvaImage: Konva.Image;
+  original: HTMLImageElement;
+  // Jobs of the same group supersede each other on the server.
+  group: string;
+  // The image as last uploaded, and the maximum dimension it was resized to
+  upload?: { maxDimension: number; blob: Blob };
+  // Number of the latest detection scheduled for the image; the results of
+  // older ones are dropped.
+  sequence: number;
+  // Settles once the latest job POSTed for the image has been answered
+  submitting?: Promise<void>;
+  // Aborts the wait of a job to be retried after a 429 response
+  retry?: AbortController;
+}
+
 interface IState {
   id: string;
   log: ILog[];
   parameters: {
     [key: string]: IParams;
   };
+  boxesOnly: boolean;
+  progressive: boolean;
+  // Longest side of the uploaded images, in pixels; 0 uploads the originals.
+  uploadMaxDimension: number;
+  streaming: boolean;
   greeting?: string;
 }
 
@@ -34,9 +78,26 @@ export class Main extends Component<{ urlPrefix: string; greeting?: string}, ISt
   private stage?: Konva.Stage;
   private layer?: Konva.Layer;
   private scheduledTasks: {
-    [key: string]: { name: string; konvaImage: Konva.Image };
+    [key: string]: {
+      name: string;
+      konvaImage: Konva.Image;
+      original: HTMLImageElement;
+      // Version of the last result displayed
+      version: number;
+    };
   } = {};
-  private pollHandler: any = null;
+  private unclaimedResults: { [key: string]: IJobResult } = {};
+  private canvasImages: ICanvasImage[] = [];
+  private watching = false;
+  private useLongPolling = false;
+  private redetectTimer?: number;
+  private video?: {
+    stream: FrameStream;
+    element: HTMLVideoElement;
+    group: Konva.Group;
+    animation: Konva.Animation;
+    stop: () => void;
+  };
   constructor(props: { urlPrefix: string; greeting?: string }) {
     super(props);
     this.state = {
@@ -58,6 +119,10 @@ export class Main extends Component<{ urlPrefix: string; greeting?: string}, ISt
           step: 1,
         },
       },
+      boxesOnly: true,
+      progressive: true,
+      uploadMaxDimension: 1920,
+      streaming: false,
       greeting: props.greeting
     };
 
@@ -86,39 +151,238 @@ export class Main extends Component<{ urlPrefix: string; greeting?: string}, ISt
   };
 
   /**
-   * Poll for result every 1 second.
+   * Update the images of finished tasks, and show the previews of running
+   * ones.
    */
-  pollForResult = () => {
-    this.pollHandler = setInterval(async () => {
-      const request = await fetch(this.makeUrl("job"), {
-        method: "GET",
-        credentials: "same-origin",
-      });
-      const results = await request.json();
+  handleResults = (results: { [key: string]: IJobResult }) => {
+    const updatedLog: ILog[] = [];
+    Object.entries(results).forEach(([taskId, result]) => {
+      if (!(taskId in this.scheduledTasks)) {
+        // The result can arrive before the POST that created the task
+        // returns; keep the latest one until the task is scheduled.
+        const unclaimed = this.unclaimedResults[taskId];
+        if (!unclaimed || (unclaimed.version || 0) <= (result.version || 0)) {
+          this.unclaimedResults[taskId] = result;
+        }
+        return;
+      }
+      const task = this.scheduledTasks[taskId];
+      if (task.konvaImage.id() !== taskId) {
+        // A newer job was submitted for this image since.
+        delete this.scheduledTasks[taskId];
+        return;
+      }
+      if (result.version !== undefined && result.version <= task.version) {
+        // Already displayed a result at least this recent
+        return;
+      }
+      task.version = result.version || 0;
+      const timings = Object.entries(result.timings || {})
+        .map(([stage, seconds]) => `${stage} ${(seconds * 1000).toFixed(1)} ms`)
+        .join(", ");
 
-      const updatedLog: ILog[] = [];
-      Object.entries(results).forEach(([taskId, imageStr]) => {
-        if (taskId in this.scheduledTasks) {
-          const task = this.scheduledTasks[taskId];
+      if (result.status === "running") {
+        // A preview: show its boxes, and keep waiting for the final result.
+        if (result.result) {
+          this.clearBoxes(task.konvaImage);
+          this.drawBoxes(task.konvaImage, result.result, true);
+          updatedLog.push(
+            this.createLog(
+              `Preview for ${task["name"]}` + (timings ? ` (${timings})` : "")
+            )
+          );
+        }
+        return;
+      }
 
-          const theImage = task.konvaImage;
+      delete this.scheduledTasks[taskId];
+      if (result.status === "done") {
+        const theImage = task.konvaImage;
+        this.clearBoxes(theImage);
+        if (result.result) {
+          theImage.image(task.original);
+          this.drawBoxes(theImage, result.result);
+        } else {
           const image = new Image();
-          image.src = `data:image/png;base64,${imageStr}`;
+          image.src = result.image_url!;
           theImage.image(image);
-          theImage.opacity(1);
-          updatedLog.push(this.createLog(`Task for ${task["name"]} finished`));
-          delete this.scheduledTasks[taskId];
         }
+        theImage.opacity(1);
+        updatedLog.push(
+          this.createLog(
+            `Task for ${task["name"]} finished` + (timings ? ` (${timings})` : "")
+          )
+        );
+      } else {
+        updatedLog.push(
+          this.createLog(
+            `Task for ${task["name"]} ${result.status}: ${result.error}`
+          )
+        );
+      }
+    });
+    if (updatedLog.length > 0) {
+      this.setState((old) => ({
+        ...old,
+        log: [...old.log, ...updatedLog],
+      }));
+    }
+  };
+
+  /**
+   * Remove the face rectangles drawn over an image.
+   */
+  clearBoxes = (theImage: Konva.Image) => {
+    theImage
+      .getParent()!
+      .find("Rect")
+      .forEach((rect) => rect.destroy());
+  };
+
+  /**
+   * Draw face rectangles over an image, scaled to its displayed size.
+   *
+   * The rectangles of a preview are dashed.
+   */
+  drawBoxes = (theImage: Konva.Image, boxes: IFaceBoxes, preview = false) => {
+    const group = theImage.getParent()!;
+    const scaleX = theImage.width() / boxes.width;
+    const scaleY = theImage.height() / boxes.height;
+    boxes.faces.forEach(([x, y, w, h]) => {
+      group.add(
+        new Konva.Rect({
+          x: x * scaleX,
+          y: y * scaleY,
+          width: w * scaleX,
+          height: h * scaleY,
+          stroke: "#0000ff",
+          strokeWidth: 2,
+          dash: preview ? [6, 4] : undefined,
+        })
+      );
+    });
+    this.layer?.draw();
+  };
+
+  hasPendingTasks = (): boolean => Object.keys(this.scheduledTasks).length > 0;
+
+  /**
+   * Watch for finished tasks while any are pending.
+   *
+   * Results are pushed by the server over Server-Sent Events.  If the event
+   * stream does not open (e.g. a proxy buffers it), fall back to long polling.
+   */
+  watchForResults = () => {
+    if (this.watching) {
+      return;
+    }
+    this.watching = true;
+    if (this.useLongPolling || !window.EventSource) {
+      this.longPollForResults();
+      return;
+    }
+
+    const events = new EventSource(this.makeUrl("job/events"), {
+      withCredentials: true,
+    });
+    const stop = () => {
+      events.close();
+      this.watching = false;
+    };
+    const fallback = setTimeout(() => {
+      stop();
+      this.useLongPolling = true;
+      this.watchForResults();
+    }, 5000);
+    events.addEventListener("ready", () => clearTimeout(fallback));
+    events.onerror = () => {
+      if (events.readyState === EventSource.CLOSED) {
+        // Refused, e.g. with a 503 when the server has too many streams
+        // open: long-poll instead, this time.
+        clearTimeout(fallback);
+        events.close();
+        this.longPollForResults();
+      }
+    };
+    events.onmessage = (e: MessageEvent) => {
+      this.handleResults(JSON.parse(e.data));
+      if (!this.hasPendingTasks()) {
+        stop();
+      }
+    };
+  };
+
+  /**
+   * Long-poll for results; the server answers as soon as any task finishes.
+   */
+  longPollForResults = async () => {
+    while (this.hasPendingTasks()) {
+      try {
+        const request = await fetch(this.makeUrl("job?wait=25"), {
+          method: "GET",
+          credentials: "same-origin",
+        });
+        if (request.status === 503) {
+          // Too many clients waiting; try again later.
+          const delay = parseInt(request.headers.get("Retry-After") || "5", 10);
+          await new Promise((resolve) => setTimeout(resolve, delay * 1000));
+          continue;
+        }
+        this.handleResults(await request.json());
+      } catch {
+        await new Promise((resolve) => setTimeout(resolve, 1000));
+      }
+    }
+    this.watching = false;
+  };
+
+  /**
+   * Submit a job, waiting and retrying while the server queue is full.
+   *
+   * Returns the job id, or undefined if ``signal`` aborted the wait for a
+   * retry.
+   */
+  submitJob = async (
+    image: Blob,
+    params: object,
+    group: string,
+    signal: AbortSignal
+  ): Promise<string | undefined> => {
+    const query = new URLSearchParams({
+      params: JSON.stringify(params),
+      group,
+    });
+    while (true) {
+      const request = await fetch(this.makeUrl(`job?${query}`), {
+        method: "POST",
+        headers: {
+          Accept: "application/json",
+          "Content-Type": image.type || "image/jpeg",
+        },
+        body: image,
+        credentials: "same-origin",
       });
-      this.setState({
-        ...this.state,
-        log: [...this.state.log, ...updatedLog],
-      });
-      if (Object.keys(this.scheduledTasks).length === 0) {
-        clearInterval(this.pollHandler);
-        this.pollHandler = null;
+      if (request.status === 429) {
+        const delay = parseInt(request.headers.get("Retry-After") || "1", 10);
+        await new Promise((resolve) => {
+          const timer = setTimeout(resolve, delay * 1000);
+          signal.addEventListener(
+            "abort",
+            () => {
+              clearTimeout(timer);
+              resolve(undefined);
+            },
+            { once: true }
+          );
+        });
+        if (signal.aborted) {
+          return undefined;
+        }
+        continue;
       }
-    }, 1000);
+      const result = await request.json();
+      return result.id;
+    }
   };
 
   handleOnDrop = async (e: React.DragEvent<HTMLDivElement>) => {
@@ -127,7 +391,6 @@ export class Main extends Component<{ urlPrefix: string; greeting?: string}, ISt
     const posY = e.nativeEvent.offsetY;
 
     const imageFiles = e.dataTransfer.files;
-    const updatedLog: ILog[] = [];
     for (let index = 0; index < imageFiles.length; index++) {
       const file = imageFiles[index];
       const url = URL.createObjectURL(file);
@@ -143,90 +406,299 @@ export class Main extends Component<{ urlPrefix: string; greeting?: string}, ISt
         const ratio = imgWidth > imgHeight ? imgWidth / max : imgHeight / max;
         const width = imgWidth / ratio;
         const height = imgHeight / ratio;
-        const theImg = new Konva.Image({
-          image: img,
+        // The image and any face rectangles drawn over it move together.
+        const group = new Konva.Group({
           x: posX - width / 2,
           y: posY - height / 2,
+          draggable: true,
+        });
+        const theImg = new Konva.Image({
+          image: img,
+          x: 0,
+          y: 0,
           width,
           height,
-          draggable: true,
           rotation: 0,
         });
         theImg.opacity(0.5);
+        group.add(theImg);
 
-        layer?.add(theImg);
+        layer?.add(group);
         layer?.draw();
-        theImg.addEventListener("dblclick", () => {
+        const item: ICanvasImage = {
+          file,
+          konvaImage: theImg,
+          original: img,
+          group: crypto.randomUUID(),
+          sequence: 0,
+        };
+        this.canvasImages.push(item);
+
+        group.addEventListener("dblclick", () => {
           URL.revokeObjectURL(url);
+          this.canvasImages = this.canvasImages.filter((i) => i !== item);
+          // Drop the detections still being submitted
+          item.sequence++;
+          item.retry?.abort();
           const id = theImg.id();
           if (id in this.scheduledTasks) {
-            const newLog = this.createLog(
-              "Removed task " + this.scheduledTasks[id]["name"]
-            );
+            this.cancelJob(id);
+            this.setLog("Removed task " + this.scheduledTasks[id]["name"]);
             delete this.scheduledTasks[id];
-            this.setState({
-              ...this.state,
-              log: [...this.state.log, newLog],
-            });
           }
-          theImg.destroy();
+          group.destroy();
           layer?.draw();
         });
-        file.arrayBuffer().then(async (arrayBuffer) => {
-          const base64 = btoa(
-            new Uint8Array(arrayBuffer).reduce(
-              (data, byte) => data + String.fromCharCode(byte),
-              ""
-            )
-          );
-          const params = {};
-          for (const key in this.state.parameters) {
-            params[key] = this.state.parameters[key].value;
-          }
-          const request = await fetch(this.makeUrl("job"), {
-            method: "POST",
-            headers: {
-              Accept: "application/json",
-              "Content-Type": "application/json",
-            },
-            body: JSON.stringify({ image: base64, params }),
-            credentials: "same-origin",
-          });
-          const result = await request.json();
-          const id = result.id;
-          const newLog = this.createLog("Scheduled task for " + file.name);
-          if (!this.pollHandler) {
-            this.pollForResult();
-          }
-          updatedLog.push(newLog);
-          theImg.id(id);
-          this.scheduledTasks[id] = { name: file.name, konvaImage: theImg };
-
-          this.setState({
-            ...this.state,
-            log: [...this.state.log, ...updatedLog],
-          });
-        });
+        this.scheduleDetection(item);
       };
     }
   };
 
+  /**
+   * The job parameters, from the current state of the parameter panel.
+   */
+  detectionParams = (): object => {
+    const params = {};
+    for (const key in this.state.parameters) {
+      params[key] = this.state.parameters[key].value;
+    }
+    if (this.state.boxesOnly) {
+      params["output"] = "boxes";
+    }
+    if (this.state.progressive) {
+      params["progressive"] = true;
+    }
+    return params;
+  };
+
+  /**
+   * Submit a detection job for an image on the canvas.
+   *
+   * A newer job for the same image supersedes this one on the server, if it
+   * has not started yet; only the result of the newest job is displayed.
+   * The jobs of an image are POSTed one at a time, so they reach the server
+   * in order, and a detection scheduled again before its job was accepted
+   * is dropped, along with its retries.
+   */
+  scheduleDetection = async (item: ICanvasImage) => {
+    const sequence = ++item.sequence;
+    item.retry?.abort();
+    const retry = new AbortController();
+    item.retry = retry;
+    const previous = item.submitting;
+    let submitted!: () => void;
+    item.submitting = new Promise((resolve) => (submitted = resolve));
+
+    let id: string | undefined;
+    try {
+      await previous;
+      if (sequence !== item.sequence) {
+        return;
+      }
+      // Upload the image as binary; no need to base64-encode it.
+      const image = await this.uploadImage(item);
+      if (sequence !== item.sequence) {
+        return;
+      }
+      id = await this.submitJob(
+        image,
+        this.detectionParams(),
+        item.group,
+        retry.signal
+      );
+    } finally {
+      submitted();
+    }
+    if (id === undefined) {
+      return;
+    }
+    if (sequence !== item.sequence) {
+      // Superseded while it was submitted
+      this.cancelJob(id);
+      return;
+    }
+    item.konvaImage.id(id);
+    this.scheduledTasks[id] = {
+      name: item.file.name,
+      konvaImage: item.konvaImage,
+      original: item.original,
+      version: 0,
+    };
+    this.setLog("Scheduled task for " + item.file.name);
+
+    if (id in this.unclaimedResults) {
+      const result = this.unclaimedResults[id];
+      delete this.unclaimedResults[id];
+      this.handleResults({ [id]: result });
+    }
+    if (id in this.scheduledTasks) {
+      // Not finished yet, or only a preview has arrived
+      this.watchForResults();
+    }
+  };
+
+  /**
+   * Return the image to upload for an image on the canvas.
+   *
+   * Large images are downscaled to the configured maximum dimension and
+   * re-encoded, in a worker, so less has to be sent and decoded; the face
+   * rectangles are scaled back to the displayed image anyway.
+   */
+  uploadImage = async (item: ICanvasImage): Promise<Blob> => {
+    const maxDimension = this.state.uploadMaxDimension;
+    if (item.upload?.maxDimension !== maxDimension) {
+      const blob = await resizeForUpload(item.file, item.original, maxDimension);
+      item.upload = { maxDimension, blob };
+    }
+    return item.upload.blob;
+  };
+
+  /**
+   * Re-run the detection on every image once the parameters stop changing,
+   * e.g. while a slider is dragged.
+   */
+  redetectSoon = () => {
+    clearTimeout(this.redetectTimer);
+    this.redetectTimer = window.setTimeout(this.redetectAll, 300);
+  };
+
+  /**
+   * Re-run the detection on every image, e.g. after a parameter changed.
+   */
+  redetectAll = () => {
+    this.canvasImages.forEach((item) => this.scheduleDetection(item));
+    this.video?.stream.configure(this.streamParams());
+  };
+
+  /**
+   * The detection parameters of a video stream.
+   */
+  streamParams = (): object => {
+    const params = {};
+    for (const key in this.state.parameters) {
+      params[key] = this.state.parameters[key].value;
+    }
+    return params;
+  };
+
+  /**
+   * Stream a webcam, or a video file, to the server and draw the faces
+   * found in each frame over the video.
+   */
+  startVideo = async (file?: File) => {
+    this.stopVideo();
+    const element = document.createElement("video");
+    element.muted = true;
+    element.playsInline = true;
+    let media: MediaStream | undefined;
+    let url: string | undefined;
+    if (file) {
+      url = URL.createObjectURL(file);
+      element.src = url;
+      element.loop = true;
+    } else {
+      try {
+        media = await navigator.mediaDevices.getUserMedia({ video: true });
+      } catch (e) {
+        this.setLog(`Could not open the webcam: ${e}`);
+        return;
+      }
+      element.srcObject = media;
+    }
+    await new Promise((resolve) => (element.onloadedmetadata = resolve));
+    element.play();
+
+    const max = 600;
+    const ratio = Math.max(element.videoWidth, element.videoHeight) / max;
+    const group = new Konva.Group({ x: 20, y: 20, draggable: true });
+    const konvaImage = new Konva.Image({
+      image: element,
+      width: element.videoWidth / ratio,
+      height: element.videoHeight / ratio,
+    });
+    group.add(konvaImage);
+    this.layer?.add(group);
+    const animation = new Konva.Animation(() => {}, this.layer);
+    animation.start();
+
+    const socketUrl = new URL(this.makeUrl("stream"), window.location.href);
+    socketUrl.protocol = socketUrl.protocol === "https:" ? "wss:" : "ws:";
+    const stream = new FrameStream(
+      socketUrl.toString(),
+      element,
+      (result: IStreamResult) => {
+        this.clearBoxes(konvaImage);
+        this.drawBoxes(konvaImage, result);
+      },
+      (reason: string) => {
+        this.setLog(`Video stream stopped: ${reason}`);
+        this.stopVideo();
+      },
+      this.streamParams()
+    );
+    const timer = setInterval(
+      () => this.setLog(`Video: ${stream.frameRate().toFixed(1)} frames/s`),
+      5000
+    );
+    this.video = {
+      stream,
+      element,
+      group,
+      animation,
+      stop: () => {
+        clearInterval(timer);
+        media?.getTracks().forEach((track) => track.stop());
+        if (url) {
+          URL.revokeObjectURL(url);
+        }
+      },
+    };
+    stream.start();
+    this.setState({ streaming: true });
+    this.setLog("Streaming " + (file ? file.name : "the webcam"));
+  };
+
+  stopVideo = () => {
+    if (!this.video) {
+      return;
+    }
+    const video = this.video;
+    this.video = undefined;
+    video.stream.stop();
+    video.stop();
+    video.animation.stop();
+    video.element.pause();
+    video.group.destroy();
+    this.layer?.draw();
+    this.setState({ streaming: false });
+  };
+
+  cancelJob = (id: string) => {
+    fetch(this.makeUrl(`job/${id}`), {
+      method: "DELETE",
+      credentials: "same-origin",
+    });
+  };
+
   preventDefault = (e: any) => {
     e.preventDefault();
     e.stopPropagation();
   };
 
   paramsOnChange = (key: string, value: number) => {
-    this.setState((old) => ({
-      ...old,
-      parameters: {
-        ...old.parameters,
-        [key]: {
-          ...old.parameters[key],
-          value,
+    this.setState(
+      (old) => ({
+        ...old,
+        parameters: {
+          ...old.parameters,
+          [key]: {
+            ...old.parameters[key],
+            value,
+          },
         },
-      },
-    }));
+      }),
+      this.redetectSoon
+    );
   };
 
   parameterForm = (key, option: IParams): JSX.Element => {
@@ -270,10 +742,10 @@ export class Main extends Component<{ urlPrefix: string; greeting?: string}, ISt
   };
   setLog = (content: string) => {
     const newLog = this.createLog(content);
-    this.setState({
-      ...this.state,
-      log: [...this.state.log, newLog],
-    });
+    this.setState((old) => ({
+      ...old,
+      log: [...old.log, newLog],
+    }));
   };
 
   render(): React.ReactNode {
@@ -288,6 +760,77 @@ export class Main extends Component<{ urlPrefix: string; greeting?: string}, ISt
               {Object.entries(this.state.parameters).map(([key, value]) =>
                 this.parameterForm(key, value)
               )}
+              <Form.Check
+                type="switch"
+                id="boxes-only"
+                label="Return face boxes only"
+                checked={this.state.boxesOnly}
+                onChange={(e) =>
+                  this.setState(
+                    { boxesOnly: e.currentTarget.checked },
+                    this.redetectAll
+                  )
+                }
+              />
+              <Form.Group>
+                <Form.Label>Upload size</Form.Label>
+                <Form.Select
+                  value={this.state.uploadMaxDimension}
+                  onChange={(e) =>
+                    this.setState(
+                      { uploadMaxDimension: parseInt(e.currentTarget.value, 10) },
+                      this.redetectAll
+                    )
+                  }
+                >
+                  <option value={0}>Original</option>
+                  {[3840, 1920, 1280, 640].map((size) => (
+                    <option key={size} value={size}>
+                      {size} px
+                    </option>
+                  ))}
+                </Form.Select>
+              </Form.Group>
+              <Form.Check
+                type="switch"
+                id="progressive"
+                label="Show a quick preview first"
+                checked={this.state.progressive}
+                onChange={(e) =>
+                  this.setState({ progressive: e.currentTarget.checked })
+                }
+              />
+              <Form.Group style={{ marginTop: "10px" }}>
+                <Form.Label>Video</Form.Label>
+                {this.state.streaming ? (
+                  <div>
+                    <Button size="sm" onClick={this.stopVideo}>
+                      Stop
+                    </Button>
+                  </div>
+                ) : (
+                  <div>
+                    <Button
+                      size="sm"
+                      style={{ marginBottom: "5px" }}
+                      onClick={() => this.startVideo()}
+                    >
+                      Start webcam
+                    </Button>
+                    <Form.Control
+                      type="file"
+                      size="sm"
+                      accept="video/*"
+                      onChange={(e) => {
+                        const files = (e.currentTarget as HTMLInputElement).files;
+                        if (files && files.length) {
+                          this.startVideo(files[0]);
+                        }
+                      }}
+                    />
+                  </div>
+                )}
+              </Form.Group>
             </Form>
           </div>
           <div className="log-panel">
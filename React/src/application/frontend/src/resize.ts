@@ -0,0 +1,108 @@
+/**
+ * Downscale images in the browser before uploading them.
+ *
+ * Sending a compact encoding of the image, rather than the original file,
+ * cuts the upload time and the server's decoding time and memory.  The
+ * work is done in a Web Worker with an OffscreenCanvas where available,
+ * and on a regular canvas otherwise.
+ */
+
+/**
+ * Return ``file`` resized so its longest side is at most ``maxDimension``,
+ * as a JPEG; or ``file`` itself if it is no larger than that.
+ */
+export const resizeBitmap = async (
+  bitmap: ImageBitmap,
+  file: Blob,
+  maxDimension: number,
+  quality: number
+): Promise<Blob> => {
+  const scale = maxDimension / Math.max(bitmap.width, bitmap.height);
+  if (scale >= 1) {
+    bitmap.close();
+    return file;
+  }
+  const width = Math.round(bitmap.width * scale);
+  const height = Math.round(bitmap.height * scale);
+  const canvas = new OffscreenCanvas(width, height);
+  const context = canvas.getContext("2d")!;
+  context.imageSmoothingQuality = "high";
+  context.drawImage(bitmap, 0, 0, width, height);
+  bitmap.close();
+  return canvas.convertToBlob({ type: "image/jpeg", quality });
+};
+
+let worker: Worker | undefined;
+let nextId = 0;
+const pending: {
+  [id: number]: { resolve: (blob: Blob) => void; reject: (e: Error) => void };
+} = {};
+
+const getWorker = (): Worker | undefined => {
+  if (worker === undefined && typeof OffscreenCanvas !== "undefined") {
+    worker = new Worker(new URL("./resize.worker.ts", import.meta.url), {
+      type: "module",
+    });
+    worker.onmessage = (e: MessageEvent) => {
+      const { id, blob, error } = e.data;
+      const request = pending[id];
+      delete pending[id];
+      if (error) {
+        request.reject(new Error(error));
+      } else {
+        request.resolve(blob);
+      }
+    };
+  }
+  return worker;
+};
+
+/**
+ * Resize on the main thread, for browsers without OffscreenCanvas.
+ */
+const resizeOnCanvas = (
+  image: HTMLImageElement,
+  file: Blob,
+  maxDimension: number,
+  quality: number
+): Promise<Blob> => {
+  const scale = maxDimension / Math.max(image.width, image.height);
+  if (scale >= 1) {
+    return Promise.resolve(file);
+  }
+  const canvas = document.createElement("canvas");
+  canvas.width = Math.round(image.width * scale);
+  canvas.height = Math.round(image.height * scale);
+  canvas.getContext("2d")!.drawImage(image, 0, 0, canvas.width, canvas.height);
+  return new Promise((resolve) =>
+    canvas.toBlob((blob) => resolve(blob || file), "image/jpeg", quality)
+  );
+};
+
+/**
+ * Return the image to upload for ``file``: downscaled to at most
+ * ``maxDimension`` pixels on its longest side and re-encoded as JPEG, or
+ * the original file if it is small enough or ``maxDimension`` is 0.
+ *
+ * ``image`` is the file, already loaded for display; it is only used when
+ * no worker is available.
+ */
+export const resizeForUpload = (
+  file: Blob,
+  image: HTMLImageElement,
+  maxDimension: number,
+  quality = 0.9
+): Promise<Blob> => {
+  if (!maxDimension) {
+    return Promise.resolve(file);
+  }
+  const resizer = getWorker();
+  if (resizer === undefined) {
+    return resizeOnCanvas(image, file, maxDimension, quality);
+  }
+  const id = nextId++;
+  return new Promise<Blob>((resolve, reject) => {
+    pending[id] = { resolve, reject };
+    resizer.postMessage({ id, file, maxDimension, quality });
+  }).catch(() => resizeOnCanvas(image, file, maxDimension, quality));
+};
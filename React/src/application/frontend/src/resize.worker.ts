@@ -0,0 +1,19 @@
+/**
+ * Web Worker that downscales and re-encodes images off the main thread.
+ *
+ * Receives { id, file, maxDimension, quality } messages, and answers
+ * { id, blob } with the resized JPEG, or the original file if it is small
+ * enough already, or { id, error }.
+ */
+import { resizeBitmap } from "./resize";
+
+self.onmessage = async (e: MessageEvent) => {
+  const { id, file, maxDimension, quality } = e.data;
+  try {
+    const bitmap = await createImageBitmap(file);
+    const blob = await resizeBitmap(bitmap, file, maxDimension, quality);
+    self.postMessage({ id, blob });
+  } catch (error) {
+    self.postMessage({ id, error: String(error) });
+  }
+};
@@ -0,0 +1,117 @@
+/**
+ * Send the frames of a video to the server's "stream" WebSocket, and get
+ * back the faces found in each.
+ *
+ * A frame is only sent once the answer for the previous one has arrived,
+ * so frames never pile up on a slow link or a busy server: the frame rate
+ * adapts to what they can handle.
+ */
+
+export interface IStreamResult {
+  frame: number;
+  width: number;
+  height: number;
+  faces: [number, number, number, number][];
+  // Whether the detector ran on this frame, or the faces were tracked
+  detected: boolean;
+  timings?: { [stage: string]: number };
+  error?: string;
+}
+
+export class FrameStream {
+  private socket?: WebSocket;
+  private canvas = document.createElement("canvas");
+  private running = false;
+  // Frames answered, and when counting started, for the frame rate
+  private answered = 0;
+  private since = performance.now();
+
+  constructor(
+    private url: string,
+    private video: HTMLVideoElement,
+    private onResult: (result: IStreamResult) => void,
+    private onClose: (reason: string) => void,
+    private options: object = {},
+    // Longest side of the frames sent, in pixels
+    private maxDimension = 640
+  ) {}
+
+  start = () => {
+    this.running = true;
+    this.socket = new WebSocket(this.url);
+    this.socket.binaryType = "arraybuffer";
+    this.socket.onopen = () => {
+      this.socket!.send(JSON.stringify(this.options));
+      this.sendFrame();
+    };
+    this.socket.onmessage = (e: MessageEvent) => {
+      const result: IStreamResult = JSON.parse(e.data);
+      if (result.error) {
+        this.onClose(result.error);
+        return;
+      }
+      this.answered++;
+      this.onResult(result);
+      requestAnimationFrame(this.sendFrame);
+    };
+    this.socket.onclose = (e: CloseEvent) => {
+      if (this.running) {
+        this.running = false;
+        this.onClose(e.reason || `connection closed (${e.code})`);
+      }
+    };
+  };
+
+  stop = () => {
+    this.running = false;
+    this.socket?.close();
+  };
+
+  /**
+   * Change the detection parameters or stream options while streaming.
+   */
+  configure = (options: object) => {
+    this.options = { ...this.options, ...options };
+    if (this.socket?.readyState === WebSocket.OPEN) {
+      this.socket.send(JSON.stringify(options));
+    }
+  };
+
+  /**
+   * Return the frames answered per second since the last call.
+   */
+  frameRate = (): number => {
+    const now = performance.now();
+    const rate = (this.answered * 1000) / (now - this.since);
+    this.answered = 0;
+    this.since = now;
+    return rate;
+  };
+
+  private sendFrame = () => {
+    if (!this.running || this.socket?.readyState !== WebSocket.OPEN) {
+      return;
+    }
+    const { videoWidth, videoHeight } = this.video;
+    if (!videoWidth || this.video.paused || this.video.ended) {
+      // Not playing yet, or paused; check again later.
+      setTimeout(this.sendFrame, 100);
+      return;
+    }
+    const scale = Math.min(1, this.maxDimension / Math.max(videoWidth, videoHeight));
+    this.canvas.width = Math.round(videoWidth * scale);
+    this.canvas.height = Math.round(videoHeight * scale);
+    this.canvas
+      .getContext("2d")!
+      .drawImage(this.video, 0, 0, this.canvas.width, this.canvas.height);
+    this.canvas.toBlob(
+      (blob) => {
+        if (blob && this.running && this.socket?.readyState === WebSocket.OPEN) {
+          this.socket.send(blob);
+        }
+      },
+      "image/jpeg",
+      0.8
+    );
+  };
+}
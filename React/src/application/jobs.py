@@ -0,0 +1,617 @@
+# Enthought product code
+#
+# (C) Copyright 2010-2022 Enthought, Inc., Austin, TX
+# All rights reserved.
+#
+# This file and its contents are confidential information and NOT open source.
+# Distribution is prohibited.
+
+"""
+    Bounded job execution for the compute tasks of the React example.
+"""
+
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+
+def result_size(result):
+    """Return the size in bytes of a job result.
+
+    Results are either binary (an encoded image) or a JSON-compatible dict.
+    """
+    if isinstance(result, dict):
+        return len(json.dumps(result))
+    return len(result)
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted and the executor has no room for it."""
+
+
+def cpu_quota():
+    """Return the number of CPUs this container is allowed to use.
+
+    The cgroup CPU quota is honoured when one is set (cgroup v2 first, then
+    v1), since ``os.cpu_count`` reports the CPUs of the host node rather
+    than the share given to the container.
+    """
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None
+    cpus = cpus or os.cpu_count() or 1
+
+    quota = None
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            limit, period = f.read().split()
+        if limit != "max":
+            quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                limit = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if limit > 0 and period > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return cpus
+
+
+def owner_label(owner):
+    """Return a short, stable label for an owner, safe to publish in stats."""
+    return hashlib.sha256(str(owner).encode("utf-8")).hexdigest()[:12]
+
+
+class OwnerStats:
+    """Per-owner queue statistics, to check that scheduling is fair.
+
+    Owners are forgotten ``idle_ttl`` seconds after their last job ends.
+    """
+
+    def __init__(self, idle_ttl=600):
+        self.idle_ttl = idle_ttl
+        self._lock = threading.Lock()
+        self._owners = {}
+
+    def queued(self, owner):
+        with self._lock:
+            self._entry(owner)["queued"] += 1
+
+    def started(self, owner, waited):
+        with self._lock:
+            entry = self._entry(owner)
+            entry["queued"] = max(0, entry["queued"] - 1)
+            entry["running"] += 1
+            entry["started"] += 1
+            entry["wait_total"] += waited
+            entry["wait_max"] = max(entry["wait_max"], waited)
+
+    def finished(self, owner):
+        with self._lock:
+            entry = self._entry(owner)
+            entry["running"] -= 1
+            entry["completed"] += 1
+            entry["last_active"] = time.monotonic()
+
+    def rejected(self, owner):
+        with self._lock:
+            self._entry(owner)["rejected"] += 1
+
+    def dropped(self, owner):
+        with self._lock:
+            entry = self._entry(owner)
+            entry["queued"] = max(0, entry["queued"] - 1)
+
+    def snapshot(self):
+        """Return the statistics of each active owner, by owner_label()."""
+        now = time.monotonic()
+        with self._lock:
+            for owner in [
+                owner
+                for owner, entry in self._owners.items()
+                if entry["queued"] == entry["running"] == 0
+                and now - entry["last_active"] > self.idle_ttl
+            ]:
+                del self._owners[owner]
+            return {
+                owner_label(owner): {
+                    "queue_depth": entry["queued"],
+                    "running": entry["running"],
+                    "completed": entry["completed"],
+                    "rejected": entry["rejected"],
+                    "wait_seconds_mean": (
+                        entry["wait_total"] / entry["started"]
+                        if entry["started"] else 0.0
+                    ),
+                    "wait_seconds_max": entry["wait_max"],
+                }
+                for owner, entry in self._owners.items()
+            }
+
+    def _entry(self, owner):
+        entry = self._owners.get(owner)
+        if entry is None:
+            entry = self._owners[owner] = {
+                "queued": 0,
+                "running": 0,
+                "started": 0,
+                "completed": 0,
+                "rejected": 0,
+                "wait_total": 0.0,
+                "wait_max": 0.0,
+                "last_active": time.monotonic(),
+            }
+        return entry
+
+
+class JobExecutor:
+    """A fixed-size worker pool with a bounded submission queue.
+
+    At most ``max_workers`` jobs run at once, and at most ``max_queued``
+    more wait for a free worker.  Submitting beyond that raises QueueFull,
+    so callers can push back on the client instead of piling up work.
+
+    Jobs are queued per owner (e.g. per client session), and free workers
+    take them from each owner in turn, rather than in order of arrival, so
+    one client submitting many jobs does not hold up the others.  An owner
+    has at most ``max_per_owner`` jobs running and ``max_queued_per_owner``
+    jobs waiting at once.
+
+    A job submitted with a ``group`` replaces the owner's jobs of the same
+    group still in the queue, which are cancelled, so a client sending a
+    stream of jobs for the same input only keeps the newest in the queue.
+    """
+
+    def __init__(self, max_workers=None, max_queued=None, max_per_owner=None,
+                 max_queued_per_owner=None):
+        self.max_workers = max_workers or cpu_quota()
+        if max_queued is None:
+            max_queued = 4 * self.max_workers
+        self.max_queued = max_queued
+        self.max_per_owner = max_per_owner or self.max_workers
+        self.max_queued_per_owner = max_queued_per_owner or self.max_queued
+
+        self._lock = threading.Lock()
+        self._work_ready = threading.Condition(self._lock)
+        # owner -> deque of (submitted, future, fn, args, kwargs, group)
+        self._pending = {}
+        # owner -> number of running jobs
+        self._owner_running = {}
+        # Owners with jobs they may start now, in turn order
+        self._turns = OrderedDict()
+        self._shutdown = False
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._rejected = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._run_total = 0.0
+        self._owner_stats = OwnerStats()
+
+        self._threads = [
+            threading.Thread(target=self._work, name=f"job-{i}", daemon=True)
+            for i in range(self.max_workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, fn, *args, owner=None, group=None, **kwargs):
+        """Schedule ``fn(*args, **kwargs)`` on behalf of ``owner``.
+
+        Returns a Future.  Raises QueueFull if every worker is busy and the
+        queue, or the owner's share of it, is full, not counting the jobs
+        this one replaces.  Those are only cancelled if it is accepted.
+        """
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("cannot submit after shutdown")
+            pending = self._pending.get(owner, deque())
+            replaced = 0
+            if group is not None:
+                replaced = sum(job[5] == group for job in pending)
+            if (
+                self._queued - replaced + self._running
+                >= self.max_workers + self.max_queued
+                or len(pending) - replaced >= self.max_queued_per_owner
+            ):
+                self._rejected += 1
+                self._owner_stats.rejected(owner)
+                raise QueueFull()
+            if replaced:
+                kept = deque()
+                for job in pending:
+                    if job[5] == group:
+                        job[1].cancel()
+                        self._owner_stats.dropped(owner)
+                    else:
+                        kept.append(job)
+                self._queued -= replaced
+                pending = kept
+            pending.append((time.monotonic(), future, fn, args, kwargs, group))
+            self._pending[owner] = pending
+            self._queued += 1
+            self._owner_stats.queued(owner)
+            self._give_turn(owner)
+        return future
+
+    def retry_after(self):
+        """Estimate how many seconds a rejected client should wait."""
+        with self._lock:
+            if self._completed == 0:
+                return 1
+            mean_run = self._run_total / self._completed
+            backlog = self._queued + self._running
+        return max(1, math.ceil(mean_run * backlog / self.max_workers))
+
+    def stats(self):
+        """Return a snapshot of queue depth and wait time statistics.
+
+        "sessions" has the same statistics for each owner with jobs.
+        """
+        with self._lock:
+            started = self._completed + self._running
+            return {
+                "workers": self.max_workers,
+                "queue_capacity": self.max_queued,
+                "queue_depth": self._queued,
+                "running": self._running,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "wait_seconds_mean": (
+                    self._wait_total / started if started else 0.0
+                ),
+                "wait_seconds_max": self._wait_max,
+                "max_per_session": self.max_per_owner,
+                "sessions": self._owner_stats.snapshot(),
+            }
+
+    def shutdown(self, wait=True):
+        """Stop accepting jobs and release the worker threads.
+
+        Jobs still in the queue are cancelled.
+        """
+        with self._lock:
+            self._shutdown = True
+            for pending in self._pending.values():
+                for _, future, *_ in pending:
+                    future.cancel()
+            self._pending.clear()
+            self._turns.clear()
+            self._queued = 0
+            self._work_ready.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _give_turn(self, owner):
+        # Put the owner at the back of the line, if it has jobs it may start.
+        if (
+            owner not in self._turns
+            and self._pending.get(owner)
+            and self._owner_running.get(owner, 0) < self.max_per_owner
+        ):
+            self._turns[owner] = None
+            self._work_ready.notify()
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while not self._turns and not self._shutdown:
+                    self._work_ready.wait()
+                if self._shutdown:
+                    return
+                owner, _ = self._turns.popitem(last=False)
+                pending = self._pending[owner]
+                submitted, future, fn, args, kwargs, _ = pending.popleft()
+                if not pending:
+                    del self._pending[owner]
+                self._queued -= 1
+                self._running += 1
+                self._owner_running[owner] = self._owner_running.get(owner, 0) + 1
+                waited = time.monotonic() - submitted
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+                self._owner_stats.started(owner, waited)
+                # The owner's next job waits for the other owners' turns.
+                self._give_turn(owner)
+
+            started = time.monotonic()
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+                self._run_total += time.monotonic() - started
+                self._owner_running[owner] -= 1
+                if not self._owner_running[owner]:
+                    del self._owner_running[owner]
+                self._owner_stats.finished(owner)
+                self._give_turn(owner)
+
+
+class ResultStore:
+    """Job states and results, keyed by task id and scoped to an owner.
+
+    The owner is typically the id of the client's Flask session, so clients
+    only ever see their own jobs.  Results are kept after they have been
+    reported, so they can be fetched separately.  Finished entries are
+    dropped ``ttl`` seconds after they finish, and the oldest finished
+    entries are evicted when their total size exceeds ``max_bytes``.
+
+    A task goes from "pending" to "running" (see start()) and then to
+    "done", "failed" or "cancelled".  A running task may publish preliminary
+    results with update(); each result has a version number, counting up
+    from 1, and the final result has the highest.  Tasks can be given a
+    ``group``, such as a hash of their input: a new task cancels the tasks of
+    the same owner and group that are still pending, since only the newest
+    one matters.  The group can also be set with supersede() once the task
+    is known to run, so that a task that is rejected cancels nothing.
+    """
+
+    def __init__(self, ttl=600, max_bytes=256 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Notified whenever a task finishes
+        self._finishing = threading.Condition(self._lock)
+        # task_id -> entry dict, for all known tasks
+        self._entries = {}
+        # owner -> set of task ids
+        self._owners = {}
+        # (owner, group) -> task ids still pending in that group
+        self._groups = {}
+        # task_id -> None, for finished tasks in order of completion
+        self._finished = OrderedDict()
+        self._bytes = 0
+
+    def add(self, owner, task_id, group=None):
+        """Register a new pending task belonging to ``owner``.
+
+        Any pending tasks of the same owner and ``group`` are cancelled.
+        """
+        with self._lock:
+            self._entries[task_id] = {
+                "owner": owner,
+                "group": None,
+                "status": "pending",
+                "result": None,
+                "error": None,
+                "size": 0,
+                "expires": None,
+                # Whether the current state has been reported already
+                "reported": True,
+                "version": 0,
+                "timings": None,
+            }
+            self._owners.setdefault(owner, set()).add(task_id)
+            if group is not None:
+                self._supersede(owner, task_id, group)
+
+    def supersede(self, owner, task_id, group):
+        """Put ``owner``'s task in ``group``, cancelling the other pending
+        tasks of that group.
+        """
+        with self._lock:
+            self._supersede(owner, task_id, group)
+
+    def finish(self, task_id, result, timings=None):
+        """Store the result of a task that completed successfully.
+
+        ``timings`` is an optional dict of the seconds spent in each stage
+        of the task, which is reported along with its state.
+        """
+        self._complete(
+            task_id, "done", result=result, size=result_size(result), timings=timings
+        )
+
+    def update(self, task_id, result, timings=None):
+        """Publish a preliminary result of a running task.
+
+        Returns False if the task is no longer running, e.g. because it was
+        cancelled, in which case it should stop.
+        """
+        with self._lock:
+            entry = self._entries.get(task_id)
+            if entry is None or entry["status"] != "running":
+                return False
+            entry.update(
+                result=result,
+                timings=timings,
+                version=entry["version"] + 1,
+                reported=False,
+            )
+            self._finishing.notify_all()
+            return True
+
+    def fail(self, task_id, error):
+        """Record that a task raised an error."""
+        self._complete(task_id, "failed", error=error)
+
+    def start(self, task_id):
+        """Mark a task as running.
+
+        Returns False if the task should not run, because it was cancelled
+        or removed while it was waiting.
+        """
+        with self._lock:
+            entry = self._entries.get(task_id)
+            if entry is None or entry["status"] != "pending":
+                return False
+            entry["status"] = "running"
+            self._ungroup(task_id, entry)
+            return True
+
+    def cancel(self, owner, task_id):
+        """Cancel one of ``owner``'s tasks.
+
+        A pending task will not run; the result of a running task will be
+        dropped.  Returns False if there is no such task.
+        """
+        with self._lock:
+            entry = self._entries.get(task_id)
+            if entry is None or entry["owner"] != owner:
+                return False
+            self._cancel(task_id, "Cancelled")
+            return True
+
+    def get(self, owner, task_id):
+        """Return the state of one of ``owner``'s tasks, or None."""
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(task_id)
+            if entry is None or entry["owner"] != owner:
+                return None
+            return self._describe(task_id, entry)
+
+    def discard(self, task_id):
+        """Forget a task, whatever its state."""
+        with self._lock:
+            if task_id in self._entries:
+                self._remove(task_id)
+
+    def get_result(self, owner, task_id):
+        """Return the result of one of ``owner``'s finished tasks, or None."""
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(task_id)
+            if entry is None or entry["owner"] != owner:
+                return None
+            return entry["result"]
+
+    def collect_finished(self, owner, timeout=0):
+        """Return ``owner``'s tasks that finished or were updated since the
+        last call.
+
+        If none have, wait up to ``timeout`` seconds for one to finish.
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while True:
+                self._expire()
+                ret = {}
+                for task_id in self._owners.get(owner, ()):
+                    entry = self._entries[task_id]
+                    if not entry["reported"]:
+                        entry["reported"] = True
+                        ret[task_id] = self._describe(task_id, entry)
+                remaining = deadline - time.monotonic()
+                if ret or remaining <= 0:
+                    return ret
+                self._finishing.wait(remaining)
+
+    def stats(self):
+        """Return a snapshot of the store's size."""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "finished": len(self._finished),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _complete(self, task_id, status, result=None, error=None, size=0,
+                  timings=None):
+        with self._lock:
+            self._set_finished(task_id, status, result, error, size, timings)
+
+    def _cancel(self, task_id, reason):
+        self._set_finished(task_id, "cancelled", None, reason, 0, None)
+
+    def _set_finished(self, task_id, status, result, error, size, timings):
+        entry = self._entries.get(task_id)
+        if entry is None or entry["status"] not in ("pending", "running"):
+            # The task was removed or cancelled while it was running.
+            return
+        self._ungroup(task_id, entry)
+        entry.update(
+            status=status,
+            result=result,
+            error=error,
+            size=size,
+            timings=timings,
+            expires=time.monotonic() + self.ttl,
+            reported=False,
+        )
+        if status == "done":
+            entry["version"] += 1
+        self._finished[task_id] = None
+        self._bytes += size
+        while self._bytes > self.max_bytes and self._finished:
+            self._remove(next(iter(self._finished)))
+        self._finishing.notify_all()
+
+    def _supersede(self, owner, task_id, group):
+        pending = self._groups.pop((owner, group), set())
+        for old_id in pending - {task_id}:
+            self._cancel(old_id, "Superseded by a newer job")
+        entry = self._entries.get(task_id)
+        if entry is not None and entry["status"] == "pending":
+            entry["group"] = group
+            self._groups[(owner, group)] = {task_id}
+
+    def _ungroup(self, task_id, entry):
+        key = (entry["owner"], entry["group"])
+        pending = self._groups.get(key)
+        if pending is not None:
+            pending.discard(task_id)
+            if not pending:
+                del self._groups[key]
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._finished:
+            task_id = next(iter(self._finished))
+            if self._entries[task_id]["expires"] > now:
+                break
+            self._remove(task_id)
+
+    def _remove(self, task_id):
+        entry = self._entries.pop(task_id)
+        self._ungroup(task_id, entry)
+        self._finished.pop(task_id, None)
+        self._bytes -= entry["size"]
+        owned = self._owners[entry["owner"]]
+        owned.discard(task_id)
+        if not owned:
+            del self._owners[entry["owner"]]
+
+    @staticmethod
+    def _describe(task_id, entry):
+        return describe_task(
+            task_id, entry["status"], entry["result"], entry["error"],
+            entry["timings"], entry["version"],
+        )
+
+
+def describe_task(task_id, status, result=None, error=None, timings=None,
+                  version=0):
+    """Return the state of a task, as reported to the client.
+
+    ``version`` is the number of results the task has published so far.
+    """
+    ret = {"id": task_id, "status": status}
+    if version:
+        ret["version"] = version
+    if isinstance(result, dict):
+        # Structured results are small, so they are returned inline.
+        ret["result"] = result
+    elif status in ("failed", "cancelled"):
+        ret["error"] = error
+    if timings is not None:
+        ret["timings"] = timings
+    return ret
@@ -0,0 +1,106 @@
+# Enthought product code
+#
+# (C) Copyright 2010-2022 Enthought, Inc., Austin, TX
+# All rights reserved.
+#
+# This file and its contents are confidential information and NOT open source.
+# Distribution is prohibited.
+
+"""
+    Minimal metrics in the Prometheus text exposition format.
+"""
+
+import bisect
+import threading
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+class Histogram:
+    """A histogram of observed values, optionally split by one label.
+
+    For example, ``Histogram("detect_stage_seconds", "...", label="stage")``
+    keeps one set of buckets per stage, and ``observe(0.2, "imdecode")``
+    records a value for the "imdecode" stage.
+    """
+
+    def __init__(self, name, help, label=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # label value -> [bucket counts..., sum, count]
+        self._series = {}
+
+    def observe(self, value, label_value=None):
+        """Record one observation."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 2)
+            # Counts are stored per bucket, and made cumulative in render().
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        """Return the histogram as lines of Prometheus text."""
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            series = {key: list(value) for key, value in self._series.items()}
+
+        for label_value, values in sorted(series.items(), key=lambda kv: str(kv[0])):
+            labels = [] if label_value is None else [f'{self.label}="{label_value}"']
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                le = ",".join(labels + [f'le="{bound}"'])
+                lines.append(f"{self.name}_bucket{{{le}}} {cumulative}")
+            le = ",".join(labels + ['le="+Inf"'])
+            lines.append(f"{self.name}_bucket{{{le}}} {values[-1]}")
+            suffix = "{" + ",".join(labels) + "}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {values[-2]}")
+            lines.append(f"{self.name}_count{suffix} {values[-1]}")
+        return lines
+
+
+def gauge(name, help, value):
+    """Return a single gauge value as lines of Prometheus text."""
+    return [
+        f"# HELP {name} {help}",
+        f"# TYPE {name} gauge",
+        f"{name} {value}",
+    ]
+
+
+def counter(name, help, value):
+    """Return a single counter value as lines of Prometheus text."""
+    return [
+        f"# HELP {name} {help}",
+        f"# TYPE {name} counter",
+        f"{name} {value}",
+    ]
+
+
+def labelled_gauge(name, help, label, values):
+    """Return a gauge with one value per label value, as lines of text.
+
+    ``values`` maps each value of the label ``label`` to the gauge's value.
+    """
+    lines = [
+        f"# HELP {name} {help}",
+        f"# TYPE {name} gauge",
+    ]
+    for label_value, value in sorted(values.items()):
+        lines.append(f'{name}{{{label}="{label_value}"}} {value}')
+    return lines
@@ -7,28 +7,631 @@
 # Distribution is prohibited.
 
 import base64
+import multiprocessing
 import os
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from multiprocessing.shared_memory import SharedMemory
 
 import cv2
 import numpy as np
 
+
 dir_path = os.path.dirname(os.path.realpath(__file__))
-face_cascade = cv2.CascadeClassifier(
-    os.path.join(dir_path, "haarcascade_frontalface_default.xml")
-)
+CASCADE_PATH = os.path.join(dir_path, "haarcascade_frontalface_default.xml")
+
+
+class ClassifierPool:
+    """A pool of cascade classifiers, so each thread uses its own instance.
+
+    A classifier is taken from the pool for the duration of a detection and
+    then returned; if none is free, a new one is loaded.  warm_up() loads
+    classifiers ahead of time and runs a dummy detection on each, so that
+    the first jobs don't pay for the lazy initialization.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._free = queue.LifoQueue()
+        # Load one now, so that a missing or broken file fails at import.
+        classifier = self._load()
+        # The (w, h) of the smallest face the classifier finds, in pixels
+        self.window_size = classifier.getOriginalWindowSize()
+        self._free.put(classifier)
+
+    def _load(self):
+        classifier = cv2.CascadeClassifier(self.path)
+        if classifier.empty():
+            raise RuntimeError(f"Could not load the cascade classifier {self.path!r}")
+        return classifier
+
+    @contextmanager
+    def acquire(self):
+        """Borrow a classifier for the duration of the ``with`` block."""
+        try:
+            classifier = self._free.get_nowait()
+        except queue.Empty:
+            classifier = self._load()
+        try:
+            yield classifier
+        finally:
+            self._free.put(classifier)
+
+    def warm_up(self, size):
+        """Make sure ``size`` warmed-up classifiers are ready for use."""
+        dummy = np.random.default_rng(0).integers(0, 256, (240, 320), np.uint8)
+        classifiers = []
+        try:
+            for _ in range(size):
+                try:
+                    classifiers.append(self._free.get_nowait())
+                except queue.Empty:
+                    classifiers.append(self._load())
+            for classifier in classifiers:
+                classifier.detectMultiScale(dummy)
+        finally:
+            for classifier in classifiers:
+                self._free.put(classifier)
+
+
+CLASSIFIERS = ClassifierPool(CASCADE_PATH)
+
+
+@contextmanager
+def stage(timings, name):
+    """Add the time spent in the ``with`` block to ``timings[name]``.
+
+    Does nothing if ``timings`` is None.
+    """
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def detect_face(encoded_data, params: dict, timings=None, on_preview=None):
+    """Detect faces in an image, and return the annotated image as a JPEG.
+
+    ``encoded_data`` is the encoded (JPEG, PNG, ...) image, either as raw
+    bytes or as a base64 string.  Raw bytes are decoded in place, without
+    being copied.
+
+    If ``params["output"]`` is "boxes", the image is not annotated and
+    re-encoded; instead a dict is returned with the image "width" and
+    "height", and the (x, y, w, h) rectangles of the "faces".
+
+    If ``timings`` is a dict, the seconds spent in each stage of the job
+    (decoding, detection, drawing, ...) are added to it, by stage name.
+
+    If ``on_preview`` is given, the faces are first found with
+    preview_params(params), on a downscaled copy of the decoded image, and
+    ``on_preview(preview, preview_timings)`` is called with the boxes found.
+    The full pass then reuses the decoded image, unless ``on_preview``
+    returns a false value, in which case it is skipped and None is returned.
+    """
+    if isinstance(encoded_data, str):
+        with stage(timings, "b64decode"):
+            encoded_data = base64.b64decode(encoded_data)
+    return _detect(encoded_data, params, timings, on_preview)
+
+
+def _detect(data, params: dict, timings=None, on_preview=None):
+    """Detect faces in the encoded image bytes in ``data``."""
+    nparr = np.frombuffer(data, np.uint8)
+    boxes = params.get("output") == "boxes"
+    if boxes:
+        with stage(timings, "imdecode"):
+            gray = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
+    else:
+        with stage(timings, "imdecode"):
+            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        with stage(timings, "cvtColor"):
+            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    if on_preview is not None:
+        preview_timings = {}
+        faces = find_faces(gray, preview_params(params), preview_timings)
+        if not on_preview(_boxes(gray, faces), preview_timings):
+            return None
 
+    faces = find_faces(gray, params, timings)
+    if boxes:
+        return _boxes(gray, faces)
 
-def detect_face(encoded_data: str, params: dict) -> str:
+    with stage(timings, "rectangle"):
+        for (x, y, w, h) in faces:
+            cv2.rectangle(img, (x, y), (x + w, y + h), (255, 0, 0), 2)
 
-    nparr = np.frombuffer(base64.b64decode(encoded_data), np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    with stage(timings, "imencode"):
+        _, buffer = cv2.imencode(".jpeg", img)
+    return buffer.tobytes()
+
+
+def _boxes(gray, faces):
+    """Return the "boxes" output for the ``faces`` found in ``gray``."""
+    return {
+        "width": gray.shape[1],
+        "height": gray.shape[0],
+        "faces": [[int(v) for v in face] for face in faces],
+    }
+
+
+def find_faces(gray, params: dict, timings=None):
+    """Return the (x, y, w, h) rectangles of the faces in a grayscale image.
+
+    If ``params["max_detect_dimension"]`` is set and the image is larger than
+    that, detection runs on a copy downscaled so its longest side is
+    ``max_detect_dimension`` pixels, and the rectangles are mapped back to
+    the coordinates of the original image.  Faces much smaller than the
+    scaling factor may then be missed, but the detection is a lot faster.
+
+    ``params["roi"]``, an (x, y, w, h) rectangle, restricts the detection to
+    that region of the image, and ``params["minSize"]`` and
+    ``params["maxSize"]``, as (w, h) or a single size, bound the size of the
+    faces searched for.  All of these are in pixels of the full image, as
+    are the rectangles returned.
+
+    With ``params["tile_size"]``, see find_faces_tiled().
+    """
+    if params.get("tile_size"):
+        return find_faces_tiled(gray, params, timings)
 
     scaleFactor = params.get("scaleFactor", 1.1)
     minNeighbors = params.get("minNeighbors", 4)
-    faces = face_cascade.detectMultiScale(gray, scaleFactor, int(minNeighbors))
-    for (x, y, w, h) in faces:
-        cv2.rectangle(img, (x, y), (x + w, y + h), (255, 0, 0), 2)
 
-    _, buffer = cv2.imencode(".jpeg", img)
-    return base64.b64encode(buffer).decode("utf-8")
+    x0, y0 = 0, 0
+    roi = params.get("roi")
+    if roi:
+        x0, y0, x1, y1 = _clip_roi(roi, gray.shape)
+        gray = gray[y0:y1, x0:x1]
+
+    scale = 1.0
+    max_dimension = params.get("max_detect_dimension")
+    if max_dimension:
+        scale = min(1.0, float(max_dimension) / max(gray.shape))
+    if scale < 1.0:
+        with stage(timings, "resize"):
+            gray = cv2.resize(
+                gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA
+            )
+
+    # Face size bounds, in pixels of the image being searched
+    sizes = {}
+    for name in ("minSize", "maxSize"):
+        if params.get(name):
+            sizes[name] = tuple(
+                max(1, int(round(v * scale))) for v in _size(params[name], name)
+            )
+
+    with stage(timings, "detectMultiScale"), CLASSIFIERS.acquire() as classifier:
+        faces = classifier.detectMultiScale(
+            gray, scaleFactor, int(minNeighbors), **sizes
+        )
+    if len(faces) and (scale < 1.0 or x0 or y0):
+        faces = np.round(np.asarray(faces) / scale).astype(int)
+        faces[:, 0] += x0
+        faces[:, 1] += y0
+    return faces
+
+
+# Tiled searches run in the calling thread, plus one extra thread for each
+# free slot of this semaphore, shared with the rest of the app; see
+# share_detect_slots().  Without it, as in the worker processes of a
+# ProcessDetector, the tiles are searched one after the other.
+_TILE_SLOTS = None
+_TILE_POOL = None
+
+
+def share_detect_slots(slots, size):
+    """Let tiled searches use the free slots of ``slots`` for extra threads.
+
+    ``slots`` is a semaphore of ``size`` slots, one per detection that may
+    run at once, and callers of find_faces() are expected to hold one of
+    them.  A tiled search then runs at most as many detections at once as
+    there are slots free, so together with the other jobs it stays within
+    the limit.
+    """
+    global _TILE_SLOTS, _TILE_POOL
+    _TILE_SLOTS = slots
+    _TILE_POOL = None
+    if size > 1:
+        _TILE_POOL = ThreadPoolExecutor(
+            max_workers=size - 1, thread_name_prefix="tile"
+        )
+
+
+def _run_tiles(search, searches):
+    """Return ``[search(args) for args in searches]``, searching some of
+    them in parallel if detection slots are free.
+    """
+    results = [None] * len(searches)
+    indices = iter(range(len(searches)))
+    lock = threading.Lock()
+
+    def drain():
+        nonlocal indices
+        while True:
+            with lock:
+                i = next(indices, None)
+            if i is None:
+                return
+            try:
+                results[i] = search(searches[i])
+            except BaseException:
+                # Stop the other threads too
+                with lock:
+                    indices = iter(())
+                raise
+
+    def helper():
+        try:
+            drain()
+        finally:
+            _TILE_SLOTS.release()
+
+    helpers = []
+    if _TILE_POOL is not None:
+        for _ in range(len(searches) - 1):
+            if not _TILE_SLOTS.acquire(blocking=False):
+                break
+            helpers.append(_TILE_POOL.submit(helper))
+    try:
+        drain()
+    finally:
+        for future in helpers:
+            future.exception()
+    for future in helpers:
+        future.result()
+    return results
+
+
+# Ratio of the scales of consecutive levels of find_faces_tiled(), relative
+# to the largest ratio for which the face sizes they search for meet.  Below
+# 1, the size ranges overlap a little, so no face size falls between them.
+TILE_LEVEL_MARGIN = 0.8
+
+
+def find_faces_tiled(gray, params: dict, timings=None):
+    """Find faces in a very large image, one tile at a time.
+
+    The image (or its "roi") is split into square tiles of
+    ``params["tile_size"]`` pixels, overlapping by ``params["tile_overlap"]``
+    pixels (an eighth of a tile by default, and at least twice the
+    classifier's window), and the tiles are searched in parallel, as far as
+    the detection slots allow (see share_detect_slots()).  OpenCV releases
+    the GIL while it searches, so the tiles can use several cores, and its
+    working memory is bounded by the tile size rather than the image size.
+
+    A face no larger than the overlap lies wholly in at least one tile, so
+    the tiles only search for faces up to that size.  Larger faces are
+    searched for in a pyramid of downscaled copies of the image, each tiled
+    the same way, down to a copy that fits in one tile.  The classifier
+    finds no face smaller than its window, so each level is downscaled just
+    enough for the smallest faces it finds to be a bit smaller than the
+    largest ones found in the level above.  Faces found twice, in
+    neighbouring tiles or on two levels, are merged with merge_boxes().
+    """
+    tile = int(params["tile_size"])
+    window = max(CLASSIFIERS.window_size)
+    overlap = int(params.get("tile_overlap") or max(tile // 8, 3 * window))
+    if not 2 * window <= overlap < tile:
+        raise ValueError(
+            f"tile_overlap must be at least {2 * window} and less than "
+            f"tile_size ({tile})"
+        )
+
+    x0, y0, x1, y1 = 0, 0, gray.shape[1], gray.shape[0]
+    if params.get("roi"):
+        x0, y0, x1, y1 = _clip_roi(params["roi"], gray.shape)
+    region = gray[y0:y1, x0:x1]
+    base = {
+        k: v for k, v in params.items()
+        if k not in (
+            "tile_size", "tile_overlap", "roi", "max_detect_dimension",
+            "minSize", "maxSize",
+        )
+    }
+    min_size, max_size = params.get("minSize"), params.get("maxSize")
+    min_w, min_h = _size(min_size, "minSize") if min_size else (0, 0)
+    max_w, max_h = _size(max_size, "maxSize") if max_size else (None, None)
+
+    # Each level is downscaled by this ratio from the one above
+    ratio = TILE_LEVEL_MARGIN * overlap / window
+    searches = []
+    scale = 1.0
+    with stage(timings, "pyramid"):
+        while True:
+            if scale < 1.0:
+                level = cv2.resize(
+                    region, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA
+                )
+            else:
+                level = region
+            height, width = level.shape
+            last = max(height, width) <= tile
+            # Face sizes searched for, in pixels of this level
+            level_max = [
+                None if limit is None else limit * scale for limit in (max_w, max_h)
+            ]
+            if not last:
+                level_max = [
+                    overlap if limit is None else min(limit, overlap)
+                    for limit in level_max
+                ]
+            level_min = [min_w * scale, min_h * scale]
+            if None not in level_max and max(level_max) < window:
+                # Every face searched for is too small for this level, and
+                # for the ones below.
+                break
+            if all(lo <= hi for lo, hi in zip(level_min, level_max) if hi is not None):
+                level_params = {**base}
+                if min_size:
+                    level_params["minSize"] = level_min
+                if None not in level_max:
+                    level_params["maxSize"] = level_max
+                step = tile - overlap
+                for y in range(0, max(1, height - overlap), step):
+                    for x in range(0, max(1, width - overlap), step):
+                        roi = [x, y, min(tile, width - x), min(tile, height - y)]
+                        searches.append(
+                            (level, {**level_params, "roi": roi}, {}, scale)
+                        )
+            if last:
+                break
+            scale = max(scale / ratio, tile / max(region.shape))
+
+    def search(args):
+        level, level_params, tile_timings, level_scale = args
+        faces = find_faces(level, level_params, tile_timings)
+        if level_scale < 1.0 and len(faces):
+            faces = np.round(np.asarray(faces) / level_scale).astype(int)
+        return faces
+
+    with stage(timings, "tiles"):
+        results = _run_tiles(search, searches)
+    if timings is not None:
+        # Summed over the tiles, so this can exceed the time of the "tiles"
+        # stage.
+        for _, _, tile_timings, _ in searches:
+            for name, seconds in tile_timings.items():
+                timings[name] = timings.get(name, 0.0) + seconds
+
+    faces = [
+        (x + x0, y + y0, w, h) for found in results for (x, y, w, h) in found
+    ]
+    with stage(timings, "merge"):
+        return merge_boxes(faces)
+
+
+def merge_boxes(faces, threshold=0.3):
+    """Merge duplicate (x, y, w, h) rectangles by non-maximum suppression.
+
+    Rectangles are kept from the largest down, and a rectangle is dropped if
+    it overlaps a kept one with an intersection over union above
+    ``threshold``, or lies mostly inside it, as a face cut by a tile border
+    does.
+    """
+    if not len(faces):
+        return np.empty((0, 4), int)
+    boxes = np.asarray(faces, dtype=int)
+    areas = boxes[:, 2] * boxes[:, 3]
+    kept = []
+    for i in np.argsort(-areas, kind="stable"):
+        x, y, w, h = boxes[i]
+        duplicate = False
+        for j in kept:
+            kx, ky, kw, kh = boxes[j]
+            iw = min(x + w, kx + kw) - max(x, kx)
+            ih = min(y + h, ky + kh) - max(y, ky)
+            if iw <= 0 or ih <= 0:
+                continue
+            inter = iw * ih
+            if (
+                inter / (areas[i] + areas[j] - inter) > threshold
+                or inter / areas[i] > 0.7
+            ):
+                duplicate = True
+                break
+        if not duplicate:
+            kept.append(i)
+    return boxes[sorted(kept)]
+
+
+def _clip_roi(roi, shape):
+    """Return the (x0, y0, x1, y1) bounds of an (x, y, w, h) region of
+    interest, clipped to an image of the given shape."""
+    try:
+        x, y, w, h = (int(v) for v in roi)
+    except (TypeError, ValueError):
+        raise ValueError(f"roi must be [x, y, width, height], not {roi!r}")
+    height, width = shape[:2]
+    x0, y0 = max(0, x), max(0, y)
+    x1, y1 = min(width, x + w), min(height, y + h)
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError(f"roi {roi!r} is outside the {width}x{height} image")
+    return x0, y0, x1, y1
+
+
+def _size(value, name):
+    """Return a face size parameter as a (w, h) pair."""
+    if isinstance(value, (int, float)):
+        return value, value
+    try:
+        w, h = value
+        return float(w), float(h)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be a size or [width, height], not {value!r}")
+
+
+# The preview pass of a progressive job detects on an image at most this
+# large, with at least this scale factor: coarse, but fast.
+PREVIEW_DIMENSION = 480
+PREVIEW_SCALE_FACTOR = 1.3
+
+
+def preview_params(params: dict):
+    """Return the parameters of the fast, coarse pass of a progressive job.
+
+    With ``params["progressive"]`` set, a job first detects faces with these
+    parameters, for a quick preview of the face rectangles, and then again
+    with ``params`` at full quality.  The preview always returns boxes, and
+    its rectangles are in the coordinates of the full image.
+    """
+    max_dimension = params.get("max_detect_dimension") or PREVIEW_DIMENSION
+    # The downscaled image is small enough to search in one go.
+    params = {
+        k: v for k, v in params.items() if k not in ("tile_size", "tile_overlap")
+    }
+    return {
+        **params,
+        "output": "boxes",
+        "scaleFactor": max(params.get("scaleFactor", 1.1), PREVIEW_SCALE_FACTOR),
+        "max_detect_dimension": min(max_dimension, PREVIEW_DIMENSION),
+    }
+
+
+def _init_worker():
+    """Process pool initializer; load and warm up the worker's classifier.
+
+    Importing this module in the worker has already checked that the
+    cascade file loads.
+    """
+    CLASSIFIERS.warm_up(1)
+
+
+def _ready():
+    return os.getpid()
+
+
+def _clear_frames(error):
+    """Drop the local variables held by the tracebacks of ``error``."""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        traceback.clear_frames(error.__traceback__)
+        error = error.__cause__ or error.__context__
+
+
+def _detect_face_shared(
+    name: str, size: int, params: dict, is_base64: bool, channel=None
+):
+    """Run detect_face on an image held in shared memory.
+
+    With ``channel``, a (previews, replies) pair of queues, the preview is
+    put on ``previews``, and the full pass waits for whether to go on from
+    ``replies``.  Returns the result and the stage timings.
+    """
+    on_preview = None
+    if channel is not None:
+        previews, replies = channel
+
+        def on_preview(preview, preview_timings):
+            previews.put((preview, preview_timings))
+            return replies.get()
+
+    timings = {}
+    shm = SharedMemory(name=name)
+    try:
+        view = shm.buf[:size]
+        try:
+            if is_base64:
+                with stage(timings, "b64decode"):
+                    data = base64.b64decode(view)
+                return _detect(data, params, timings, on_preview), timings
+            return _detect(view, params, timings, on_preview), timings
+        except BaseException as e:
+            # The traceback keeps the frames of _detect alive, and with them
+            # the array wrapping the shared memory, which would make release()
+            # raise BufferError in place of this error.
+            _clear_frames(e)
+            raise
+        finally:
+            view.release()
+    finally:
+        shm.close()
+
+
+class ProcessDetector:
+    """Run detect_face in a pool of worker processes.
+
+    Each worker loads the Haar cascade once, when the process starts.  The
+    uploaded image is copied into a shared memory block, rather than being
+    pickled, and decoded in the worker; this keeps the base64 decoding and
+    the image codecs off the interpreter that serves requests.
+
+    The previews of progressive jobs are sent back through queues of a
+    multiprocessing manager, started on the first such job.
+    """
+
+    def __init__(self, max_workers: int):
+        self._context = multiprocessing.get_context("spawn")
+        self._pool = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=self._context,
+            initializer=_init_worker,
+        )
+        self._manager = None
+        self._manager_lock = threading.Lock()
+        # Start the workers now rather than on the first job.  If they can't
+        # load the classifier, this raises BrokenProcessPool.
+        for future in [self._pool.submit(_ready) for _ in range(max_workers)]:
+            future.result()
+
+    def _channel(self):
+        """Return new (previews, replies) queues for a progressive job."""
+        with self._manager_lock:
+            if self._manager is None:
+                self._manager = self._context.Manager()
+            return self._manager.Queue(), self._manager.Queue()
+
+    def detect_face(self, encoded_data, params: dict, timings=None, on_preview=None):
+        is_base64 = isinstance(encoded_data, str)
+        data = encoded_data.encode("ascii") if is_base64 else encoded_data
+        channel = None if on_preview is None else self._channel()
+        shm = SharedMemory(create=True, size=max(1, len(data)))
+        try:
+            shm.buf[: len(data)] = data
+            future = self._pool.submit(
+                _detect_face_shared, shm.name, len(data), params, is_base64,
+                channel,
+            )
+            if channel is not None:
+                self._relay_preview(future, channel, on_preview)
+            result, worker_timings = future.result()
+        finally:
+            shm.close()
+            shm.unlink()
+        if timings is not None:
+            timings.update(worker_timings)
+        return result
+
+    def _relay_preview(self, future, channel, on_preview):
+        """Pass the preview of the job ``future`` to ``on_preview``."""
+        previews, replies = channel
+        while True:
+            try:
+                preview, preview_timings = previews.get(timeout=0.1)
+            except queue.Empty:
+                if future.done():
+                    # Failed before the preview
+                    return
+                continue
+            go_on = False
+            try:
+                go_on = bool(on_preview(preview, preview_timings))
+            finally:
+                replies.put(go_on)
+            return
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+        if self._manager is not None:
+            self._manager.shutdown()
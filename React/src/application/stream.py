@@ -0,0 +1,163 @@
+# Enthought product code
+#
+# (C) Copyright 2010-2022 Enthought, Inc., Austin, TX
+# All rights reserved.
+#
+# This file and its contents are confidential information and NOT open source.
+# Distribution is prohibited.
+
+"""
+    Face detection on a stream of video frames.
+
+    Running the cascade classifier on every frame is too slow for real time.
+    Instead, FaceTracker runs it every few frames, or when the picture
+    changes a lot, and in between follows the faces it found with sparse
+    optical flow, which costs a few milliseconds per frame.
+"""
+
+import cv2
+import numpy as np
+
+from .opencv_model.model import find_faces, stage
+
+# Defaults for the stream options; see FaceTracker.configure().
+DEFAULT_OPTIONS = {
+    # Run the detector at least every this many frames
+    "detect_every": 10,
+    # Mean absolute difference between consecutive frames (0-255) above
+    # which the detector runs at once
+    "motion_threshold": 12.0,
+    # Longest side of the frames used for motion and tracking, in pixels
+    "track_dimension": 320,
+    # Longest side of the frames the detector runs on, in pixels
+    "max_detect_dimension": 480,
+}
+
+
+class FaceTracker:
+    """The state of one stream of frames.
+
+    Only the previous frame, downscaled for tracking, and the current face
+    rectangles are kept, so the memory used by a stream does not grow with
+    its length.
+    """
+
+    def __init__(self, options=None):
+        self.params = {}
+        self.options = dict(DEFAULT_OPTIONS)
+        if options:
+            self.configure(options)
+        self.frames = 0
+        self.detections = 0
+        # Previous frame, downscaled for tracking
+        self._previous = None
+        # Face rectangles (x, y, w, h), as floats in full-frame coordinates
+        self._faces = np.empty((0, 4), float)
+        self._since_detection = 0
+
+    def configure(self, options):
+        """Update the detection parameters and the stream options.
+
+        ``options`` can hold the detection parameters of a job, such as
+        "scaleFactor", "minNeighbors", "roi" or "minSize", and the keys of
+        DEFAULT_OPTIONS.
+        """
+        for key, value in options.items():
+            if key in DEFAULT_OPTIONS:
+                value = float(value)
+                if value <= 0:
+                    raise ValueError(f"{key} must be positive")
+                self.options[key] = value
+            else:
+                self.params[key] = value
+        # Detect again with the new parameters
+        self._previous = None
+
+    def process(self, data, timings=None):
+        """Find the faces in the next frame, an encoded image.
+
+        Returns a dict with the frame number, the frame "width" and "height",
+        the (x, y, w, h) rectangles of the "faces", and whether the detector
+        ran ("detected") or the faces were tracked from the previous frame.
+        """
+        with stage(timings, "imdecode"):
+            gray = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            raise ValueError("Could not decode the frame")
+
+        scale = min(1.0, self.options["track_dimension"] / max(gray.shape))
+        with stage(timings, "resize"):
+            small = (
+                cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                if scale < 1.0 else gray
+            )
+
+        detect = (
+            self._previous is None
+            or self._previous.shape != small.shape
+            or self._since_detection + 1 >= self.options["detect_every"]
+        )
+        if not detect:
+            with stage(timings, "motion"):
+                motion = float(cv2.absdiff(small, self._previous).mean())
+            detect = motion > self.options["motion_threshold"]
+        if not detect and len(self._faces):
+            with stage(timings, "track"):
+                tracked = self._track(small, scale)
+            if tracked is None:
+                # Lost a face; look for them again
+                detect = True
+            else:
+                self._faces = tracked
+
+        if detect:
+            params = {
+                **self.params,
+                "max_detect_dimension": self.options["max_detect_dimension"],
+            }
+            self._faces = np.asarray(find_faces(gray, params, timings), float)
+            self._faces = self._faces.reshape(-1, 4)
+            self._since_detection = 0
+            self.detections += 1
+        else:
+            self._since_detection += 1
+
+        self._previous = small
+        self.frames += 1
+        return {
+            "frame": self.frames,
+            "width": gray.shape[1],
+            "height": gray.shape[0],
+            "faces": [[int(round(v)) for v in face] for face in self._faces],
+            "detected": detect,
+        }
+
+    def _track(self, small, scale):
+        """Move the face rectangles along with the optical flow inside them.
+
+        Returns the new rectangles, or None if a face could not be tracked.
+        """
+        moved = []
+        for x, y, w, h in self._faces * scale:
+            x0, y0 = max(0, int(x)), max(0, int(y))
+            x1 = min(small.shape[1], int(x + w))
+            y1 = min(small.shape[0], int(y + h))
+            if x1 - x0 < 4 or y1 - y0 < 4:
+                return None
+            mask = np.zeros_like(small)
+            mask[y0:y1, x0:x1] = 255
+            points = cv2.goodFeaturesToTrack(
+                self._previous, maxCorners=30, qualityLevel=0.01, minDistance=2,
+                mask=mask,
+            )
+            if points is None or len(points) < 4:
+                return None
+            new_points, status, _ = cv2.calcOpticalFlowPyrLK(
+                self._previous, small, points, None
+            )
+            found = status.ravel() == 1
+            if found.sum() < len(points) // 2:
+                return None
+            dx, dy = np.median((new_points - points)[found].reshape(-1, 2), axis=0)
+            moved.append([x + dx, y + dy, w, h])
+        return np.asarray(moved, float).reshape(-1, 4) / scale
@@ -10,4 +10,4 @@ if [ -z $HOST_ADDRESS ]; then
   export HOST_ADDRESS='127.0.0.1';
 fi
 
-exec edm run -- gunicorn application.app:app -b ${HOST_ADDRESS}:9000 --workers 1
+exec edm run -- gunicorn application.app:app -b ${HOST_ADDRESS}:9000 --workers ${GUNICORN_WORKERS:-1} --threads ${GUNICORN_THREADS:-8}
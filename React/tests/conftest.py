@@ -0,0 +1,12 @@
+# Enthought product code
+#
+# (C) Copyright 2010-2022 Enthought, Inc., Austin, TX
+# All rights reserved.
+#
+# This file and its contents are confidential information and NOT open source.
+# Distribution is prohibited.
+
+import os.path as op
+import sys
+
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), "..", "src"))
@@ -0,0 +1,252 @@
+# Enthought product code
+#
+# (C) Copyright 2010-2022 Enthought, Inc., Austin, TX
+# All rights reserved.
+#
+# This file and its contents are confidential information and NOT open source.
+# Distribution is prohibited.
+
+"""
+    Interface checks run against ResultStore and both job brokers.
+
+    RedisBroker runs against fakeredis, an in-process stand-in for a Redis
+    server; those tests are skipped if it is not installed.
+"""
+
+import time
+
+import pytest
+
+from application.brokers import RedisBroker, SQLiteBroker
+from application.jobs import ResultStore
+
+STORES = ["memory", "sqlite", "redis"]
+BROKERS = ["sqlite", "redis"]
+
+
+def make_store(kind, tmp_path, ttl=600, max_bytes=1024 * 1024):
+    if kind == "memory":
+        return ResultStore(ttl=ttl, max_bytes=max_bytes)
+    if kind == "sqlite":
+        return SQLiteBroker(
+            str(tmp_path / "jobs.sqlite"), ttl=ttl, max_bytes=max_bytes,
+            poll_interval=0.01,
+        )
+    fakeredis = pytest.importorskip("fakeredis")
+    return RedisBroker(fakeredis.FakeRedis(), ttl=ttl, max_bytes=max_bytes)
+
+
+@pytest.fixture(params=STORES)
+def store(request, tmp_path):
+    return make_store(request.param, tmp_path)
+
+
+@pytest.fixture(params=BROKERS)
+def broker(request, tmp_path):
+    return make_store(request.param, tmp_path)
+
+
+def test_supersede_reports_cancelled_job(store):
+    store.add("alice", "j1", group="g")
+    store.add("alice", "j2", group="g")
+    assert not store.start("j1")
+    assert store.start("j2")
+    store.finish("j2", {"faces": []})
+
+    finished = store.collect_finished("alice")
+
+    assert finished["j1"]["status"] == "cancelled"
+    assert finished["j1"]["error"] == "Superseded by a newer job"
+    assert finished["j2"]["status"] == "done"
+    assert store.collect_finished("alice") == {}
+
+
+def test_supersede_spares_running_job(store):
+    store.add("alice", "j1", group="g")
+    assert store.start("j1")
+    store.add("alice", "j2", group="g")
+
+    assert store.get("alice", "j1")["status"] == "running"
+
+
+def test_supersede_once_accepted(store):
+    store.add("alice", "j1", group="g")
+    store.add("alice", "j2")
+    assert store.get("alice", "j1")["status"] == "pending"
+
+    store.supersede("alice", "j2", "g")
+    assert store.get("alice", "j1")["status"] == "cancelled"
+    assert store.get("alice", "j2")["status"] == "pending"
+
+    store.add("alice", "j3", group="g")
+    assert store.get("alice", "j2")["status"] == "cancelled"
+
+
+def test_cancel(store):
+    store.add("alice", "j1")
+
+    assert not store.cancel("bob", "j1")
+    assert store.cancel("alice", "j1")
+    assert not store.start("j1")
+    assert store.get("alice", "j1")["status"] == "cancelled"
+    assert store.collect_finished("alice")["j1"]["status"] == "cancelled"
+    assert store.get("bob", "j1") is None
+
+
+def test_update_versions(store):
+    store.add("alice", "j1")
+    assert not store.update("j1", {"faces": []})
+    assert store.start("j1")
+
+    assert store.update("j1", {"faces": [[1, 2, 3, 4]]})
+    preview = store.collect_finished("alice")["j1"]
+    assert preview["status"] == "running"
+    assert preview["version"] == 1
+    assert preview["result"] == {"faces": [[1, 2, 3, 4]]}
+
+    store.finish("j1", {"faces": [[5, 6, 7, 8]]})
+    final = store.collect_finished("alice")["j1"]
+    assert final["status"] == "done"
+    assert final["version"] == 2
+    assert final["result"] == {"faces": [[5, 6, 7, 8]]}
+    assert not store.update("j1", {"faces": []})
+
+
+def test_binary_result(store):
+    store.add("alice", "j1")
+    store.start("j1")
+    store.finish("j1", b"image")
+
+    assert store.get_result("alice", "j1") == b"image"
+    assert store.get_result("bob", "j1") is None
+    assert "result" not in store.get("alice", "j1")
+
+
+@pytest.mark.parametrize("kind", STORES)
+def test_ttl_expiry(kind, tmp_path):
+    store = make_store(kind, tmp_path, ttl=0.2)
+    store.add("alice", "j1")
+    store.start("j1")
+    store.finish("j1", b"image")
+    assert store.get("alice", "j1") is not None
+
+    time.sleep(0.4)
+
+    assert store.get("alice", "j1") is None
+    assert store.get_result("alice", "j1") is None
+
+
+@pytest.mark.parametrize("kind", STORES)
+def test_byte_budget_eviction(kind, tmp_path):
+    store = make_store(kind, tmp_path, max_bytes=10)
+    for task_id in ("j1", "j2"):
+        store.add("alice", task_id)
+        store.start(task_id)
+        store.finish(task_id, b"x" * 6)
+
+    assert store.get("alice", "j1") is None
+    assert store.get_result("alice", "j2") == b"x" * 6
+    assert store.stats()["bytes"] == 6
+
+
+def queue(broker, owner, task_id):
+    broker.add(owner, task_id)
+    broker.put_job(task_id, b"image", {"scaleFactor": 1.1}, key="key")
+
+
+def test_take_job(broker):
+    queue(broker, "alice", "j1")
+    assert broker.queue_depth() == 1
+
+    task_id, owner, image, params, key, queued = broker.take_job(timeout=0)
+
+    assert (task_id, owner, image, params, key) == (
+        "j1", "alice", b"image", {"scaleFactor": 1.1}, "key"
+    )
+    assert queued <= time.time()
+    assert broker.queue_depth() == 0
+    assert broker.take_job(timeout=0) is None
+
+
+def test_take_job_skips_cancelled(broker):
+    queue(broker, "alice", "j1")
+    queue(broker, "alice", "j2")
+    broker.cancel("alice", "j1")
+
+    assert broker.take_job(timeout=0)[0] == "j2"
+
+
+def test_take_job_owners_take_turns(broker):
+    for i in range(3):
+        queue(broker, "alice", f"a{i}")
+    for i in range(2):
+        queue(broker, "bob", f"b{i}")
+
+    owners = []
+    while True:
+        job = broker.take_job(timeout=0)
+        if job is None:
+            break
+        owners.append(job[1])
+        # Keep the jobs apart in time, for the ordering by start time
+        time.sleep(0.01)
+
+    assert sorted(owners) == ["alice"] * 3 + ["bob"] * 2
+    assert owners[0] != owners[1]
+    assert owners[2] != owners[3]
+    assert broker.queue_depth("alice") == broker.queue_depth("bob") == 0
+
+
+def test_take_job_max_per_owner(broker):
+    for i in range(2):
+        queue(broker, "alice", f"a{i}")
+    queue(broker, "bob", "b0")
+
+    first = broker.take_job(timeout=0, max_per_owner=1)
+    second = broker.take_job(timeout=0, max_per_owner=1)
+    assert {first[1], second[1]} == {"alice", "bob"}
+    assert broker.take_job(timeout=0, max_per_owner=1) is None
+
+    # Finishing alice's job lets her next one run
+    alice_job = first if first[1] == "alice" else second
+    broker.start(alice_job[0])
+    broker.finish(alice_job[0], {"faces": []})
+    assert broker.take_job(timeout=0, max_per_owner=1)[0] == "a1"
+
+
+def test_cancel_taken_job_frees_its_slot(broker):
+    for i in range(2):
+        queue(broker, "alice", f"a{i}")
+    assert broker.take_job(timeout=0, max_per_owner=1)[0] == "a0"
+    assert broker.take_job(timeout=0, max_per_owner=1) is None
+
+    # Cancelled before the worker could start it
+    broker.cancel("alice", "a0")
+    assert not broker.start("a0")
+    assert broker.take_job(timeout=0, max_per_owner=1)[0] == "a1"
+
+
+def test_cancelled_job_leaves_queue(broker):
+    broker.add("alice", "j1", group="g")
+    broker.put_job("j1", b"image", {})
+    assert broker.queue_depth("alice") == 1
+
+    broker.add("alice", "j2", group="g")
+    assert broker.queue_depth("alice") == 0
+    assert broker.queue_depth() == 0
+    assert broker.take_job(timeout=0) is None
+
+
+def test_sqlite_idle_polls_do_not_write(tmp_path):
+    broker = make_store("sqlite", tmp_path)
+    broker.add("alice", "j1")
+    broker.collect_finished("alice")
+    broker.take_job(timeout=0)
+    statements = []
+    broker._db().set_trace_callback(statements.append)
+
+    broker.collect_finished("alice", timeout=0.05)
+    broker.take_job(timeout=0.05)
+
+    assert statements
+    assert all(s.lstrip().startswith("SELECT") for s in statements)
@@ -0,0 +1,61 @@
+# Enthought product code
+#
+# (C) Copyright 2010-2022 Enthought, Inc., Austin, TX
+# All rights reserved.
+#
+# This file and its contents are confidential information and NOT open source.
+# Distribution is prohibited.
+
+"""
+    Tests of the in-process job executor.
+"""
+
+import threading
+
+import pytest
+
+from application.jobs import JobExecutor, QueueFull
+
+
+@pytest.fixture
+def executor():
+    executor = JobExecutor(max_workers=1, max_queued=2, max_queued_per_owner=2)
+    yield executor
+    executor.shutdown()
+
+
+def block(executor):
+    """Keep the executor's only worker busy until the event is set."""
+    release = threading.Event()
+    started = threading.Event()
+
+    def run():
+        started.set()
+        release.wait()
+
+    executor.submit(run, owner="other")
+    started.wait()
+    return release
+
+
+def test_group_replaces_queued_jobs(executor):
+    release = block(executor)
+    futures = [
+        executor.submit(lambda i=i: i, owner="alice", group="image")
+        for i in range(4)
+    ]
+    assert [f.cancelled() for f in futures] == [True, True, True, False]
+    assert executor.stats()["queue_depth"] == 1
+    release.set()
+    assert futures[-1].result(timeout=5) == 3
+
+
+def test_rejected_job_replaces_nothing(executor):
+    release = block(executor)
+    first = executor.submit(lambda: 1, owner="alice", group="a")
+    executor.submit(lambda: 2, owner="alice", group="b")
+    with pytest.raises(QueueFull):
+        executor.submit(lambda: 3, owner="alice", group="c")
+    assert not first.cancelled()
+    release.set()
+    assert first.result(timeout=5) == 1
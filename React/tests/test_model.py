@@ -0,0 +1,224 @@
+# Enthought product code
+#
+# (C) Copyright 2010-2022 Enthought, Inc., Austin, TX
+# All rights reserved.
+#
+# This file and its contents are confidential information and NOT open source.
+# Distribution is prohibited.
+
+"""
+    Tests of the OpenCV face detection model.
+"""
+
+from multiprocessing.shared_memory import SharedMemory
+
+import pytest
+
+from application.opencv_model import model
+
+
+def shared(data):
+    shm = SharedMemory(create=True, size=len(data))
+    shm.buf[:len(data)] = data
+    return shm
+
+
+@pytest.mark.parametrize("is_base64", [False, True])
+def test_detect_face_shared_keeps_decode_error(is_base64):
+    data = b"bm90IGFuIGltYWdl" if is_base64 else b"not an image"
+    shm = shared(data)
+    try:
+        with pytest.raises(Exception) as info:
+            model._detect_face_shared(shm.name, len(data), {}, is_base64)
+        assert not isinstance(info.value, BufferError)
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def test_detect_face_shared_result():
+    import cv2
+    import numpy as np
+
+    _, encoded = cv2.imencode(".png", np.full((64, 64), 128, np.uint8))
+    data = encoded.tobytes()
+    shm = shared(data)
+    try:
+        result, timings = model._detect_face_shared(
+            shm.name, len(data), {"output": "boxes"}, False
+        )
+    finally:
+        shm.close()
+        shm.unlink()
+    assert result == {"width": 64, "height": 64, "faces": []}
+    assert "imdecode" in timings
+
+
+def fake_detector(monkeypatch, full_width, box):
+    """Make find_faces() "see" the face ``box`` of the full-size image.
+
+    The face is found in an image (a tile, or a level of the pyramid of
+    find_faces_tiled) if it lies wholly in the searched region and its size
+    is within the classifier's limits.
+    """
+    window = max(model.CLASSIFIERS.window_size)
+
+    def find_faces(gray, params, timings=None):
+        scale = gray.shape[1] / full_width
+        x, y, w, h = (v * scale for v in box)
+        rx, ry, rw, rh = params.get("roi", (0, 0, gray.shape[1], gray.shape[0]))
+        inside = rx <= x and ry <= y and x + w <= rx + rw and y + h <= ry + rh
+        # Sizes in pixels of the image searched by detectMultiScale
+        detect_scale = 1.0
+        if params.get("max_detect_dimension"):
+            detect_scale = min(1.0, params["max_detect_dimension"] / max(rw, rh))
+        min_w = model._size(params.get("minSize", 0), "minSize")[0]
+        min_w = max(window, min_w * detect_scale)
+        max_w = model._size(params.get("maxSize", float("inf")), "maxSize")[0]
+        if inside and min_w <= w * detect_scale <= max_w * detect_scale:
+            return [[round(x), round(y), round(w), round(h)]]
+        return []
+
+    monkeypatch.setattr(model, "find_faces", find_faces)
+
+
+@pytest.mark.parametrize("size", [40, 128, 200, 300, 470, 1000, 1900])
+def test_find_faces_tiled_finds_every_size(monkeypatch, size):
+    import numpy as np
+
+    gray = np.zeros((2000, 20000), np.uint8)
+    # Across the border of the first two tiles
+    box = (1000 - size // 2, 50, size, size)
+    fake_detector(monkeypatch, gray.shape[1], box)
+
+    faces = model.find_faces_tiled(gray, {"tile_size": 1024})
+
+    assert len(faces) == 1
+    found = faces[0]
+    assert all(abs(a - b) <= max(2, size // 20) for a, b in zip(found, box))
+
+
+def test_find_faces_tiled_size_bounds(monkeypatch):
+    import numpy as np
+
+    gray = np.zeros((2000, 20000), np.uint8)
+    fake_detector(monkeypatch, gray.shape[1], (5000, 50, 300, 300))
+
+    assert len(model.find_faces_tiled(
+        gray, {"tile_size": 1024, "maxSize": 200}
+    )) == 0
+    assert len(model.find_faces_tiled(
+        gray, {"tile_size": 1024, "minSize": 400}
+    )) == 0
+    assert len(model.find_faces_tiled(
+        gray, {"tile_size": 1024, "minSize": 250, "maxSize": 350}
+    )) == 1
+
+
+def test_find_faces_tiled_overlap_too_small():
+    import numpy as np
+
+    with pytest.raises(ValueError):
+        model.find_faces_tiled(
+            np.zeros((100, 100), np.uint8), {"tile_size": 64, "tile_overlap": 8}
+        )
+
+
+def encoded_image(width=640, height=480):
+    import cv2
+    import numpy as np
+
+    image = np.random.default_rng(0).integers(0, 256, (height, width), np.uint8)
+    return cv2.imencode(".png", image)[1].tobytes()
+
+
+@pytest.mark.parametrize("output", ["boxes", "image"])
+def test_detect_face_preview_decodes_once(monkeypatch, output):
+    import cv2
+
+    decoded = []
+    imdecode = cv2.imdecode
+    monkeypatch.setattr(
+        cv2, "imdecode", lambda *args: decoded.append(args[1]) or imdecode(*args)
+    )
+    searched = []
+    find_faces = model.find_faces
+    monkeypatch.setattr(
+        model, "find_faces",
+        lambda gray, params, timings=None: searched.append(params)
+        or find_faces(gray, params, timings),
+    )
+    previews = []
+    params = {"output": output, "tile_size": 256}
+    result = model.detect_face(
+        encoded_image(), params, {}, lambda *args: previews.append(args) or True
+    )
+    assert len(decoded) == 1
+    assert previews[0][0]["width"] == 640
+    # The preview is searched at a reduced size, in one go
+    assert searched[0]["max_detect_dimension"] == model.PREVIEW_DIMENSION
+    assert "tile_size" not in searched[0]
+    assert searched[1] == params
+    assert result is not None
+
+
+def test_detect_face_preview_cancelled():
+    result = model.detect_face(
+        encoded_image(), {"output": "boxes"}, {}, lambda *args: False
+    )
+    assert result is None
+
+
+@pytest.mark.parametrize("go_on", [True, False])
+def test_process_detector_preview(go_on):
+    detector = model.ProcessDetector(1)
+    try:
+        previews = []
+        result = detector.detect_face(
+            encoded_image(), {"output": "boxes"}, {},
+            lambda *args: previews.append(args) or go_on,
+        )
+    finally:
+        detector.shutdown()
+    assert previews[0][0]["width"] == 640
+    if go_on:
+        assert result["width"] == 640
+    else:
+        assert result is None
+
+
+@pytest.mark.parametrize("free", [0, 2])
+def test_find_faces_tiled_stays_within_slots(monkeypatch, free):
+    import threading
+    import time
+
+    import numpy as np
+
+    slots = threading.BoundedSemaphore(3)
+    model.share_detect_slots(slots, 3)
+    # The caller holds one slot, and other jobs hold the ones not free.
+    for _ in range(3 - free):
+        slots.acquire()
+    running = []
+    most = []
+    lock = threading.Lock()
+
+    def find_faces(gray, params, timings=None):
+        with lock:
+            running.append(None)
+            most.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.pop()
+        return []
+
+    monkeypatch.setattr(model, "find_faces", find_faces)
+    try:
+        model.find_faces_tiled(np.zeros((1000, 1000), np.uint8), {"tile_size": 200})
+        assert max(most) == 1 + free
+        # Every slot taken by the tiles was given back
+        for _ in range(free):
+            assert slots.acquire(blocking=False)
+        assert not slots.acquire(blocking=False)
+    finally:
+        model.share_detect_slots(None, 1)
@@ -0,0 +1,128 @@
+# Enthought product code
+#
+# (C) Copyright 2010-2022 Enthought, Inc., Austin, TX
+# All rights reserved.
+#
+# This file and its contents are confidential information and NOT open source.
+# Distribution is prohibited.
+
+"""
+    Micro-benchmark of the requests/sec of a Flask example under gunicorn.
+
+    Each directory given on the command line is served with
+    "gunicorn main:app", and its root page is requested as fast as possible
+    by a few client threads for a fixed time.  The requests/sec and latency
+    percentiles are printed for each, so two versions of an app can be
+    compared, for example the current one and a checkout made with
+    "git worktree add /tmp/before <revision>":
+
+    Usage:  python benchmark.py ../Kubernetes/src /tmp/before/Kubernetes/src
+"""
+
+import os
+import os.path as op
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import click
+import requests
+from click import secho
+
+
+@click.command()
+@click.argument("app_dirs", nargs=-1, required=True)
+@click.option("--port", default=9100, help="Port to serve the apps on")
+@click.option("--workers", default=1, help="Number of gunicorn workers")
+@click.option("--clients", default=4, help="Number of client threads")
+@click.option("--duration", default=10.0, help="Seconds to run each benchmark")
+@click.option("--warmup", default=2.0, help="Seconds to run before measuring")
+def benchmark(app_dirs, port, workers, clients, duration, warmup):
+    """Measure the requests/sec of Flask apps under gunicorn."""
+
+    url = f"http://127.0.0.1:{port}/"
+    print(f"{'app':<40} {'req/s':>8} {'p50 (ms)':>9} {'p99 (ms)':>9}")
+    for app_dir in app_dirs:
+        with serve(op.abspath(app_dir), port, workers):
+            load(url, clients, warmup)
+            latencies, errors = load(url, clients, duration)
+        if errors:
+            secho(f"{app_dir}: {errors} request(s) failed", fg="red")
+        if not latencies:
+            continue
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[int(len(latencies) * 0.99)] * 1000
+        rate = len(latencies) / duration
+        print(f"{app_dir:<40} {rate:8.1f} {p50:9.2f} {p99:9.2f}")
+
+
+@contextmanager
+def serve(app_dir, port, workers):
+    """Run gunicorn on the app in ``app_dir`` until the context exits."""
+    command = [
+        sys.executable, "-m", "gunicorn", "main:app",
+        "--chdir", app_dir,
+        "-b", f"127.0.0.1:{port}",
+        "-w", str(workers),
+    ]
+    process = subprocess.Popen(
+        command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        env=dict(os.environ, PREFIX="/", JUPYTERHUB_SERVICE_PREFIX="/"),
+    )
+    try:
+        for _ in range(100):
+            try:
+                requests.get(f"http://127.0.0.1:{port}/", timeout=1)
+                break
+            except requests.ConnectionError:
+                if process.poll() is not None:
+                    raise click.ClickException(f"gunicorn failed for {app_dir}")
+                time.sleep(0.1)
+        else:
+            raise click.ClickException(f"Timed out starting {app_dir}")
+        yield
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def load(url, clients, duration):
+    """Request ``url`` from several threads for ``duration`` seconds.
+
+    Returns the latencies of the successful requests, and the number of
+    failed requests.
+    """
+    latencies = []
+    errors = []
+    deadline = time.perf_counter() + duration
+
+    def client():
+        mine = []
+        failed = 0
+        with requests.Session() as session:
+            while True:
+                start = time.perf_counter()
+                if start >= deadline:
+                    break
+                try:
+                    session.get(url).raise_for_status()
+                except requests.RequestException:
+                    failed += 1
+                    continue
+                mine.append(time.perf_counter() - start)
+        latencies.extend(mine)
+        errors.append(failed)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, sum(errors)
+
+
+if __name__ == "__main__":
+    benchmark()